@@ -3,6 +3,7 @@
 """
 
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, status, BackgroundTasks
+from sqlalchemy import delete
 from sqlmodel import Session, select, func
 from typing import List, Dict
 import os
@@ -13,7 +14,7 @@ from app.core.database import get_session
 from app.core.config import get_settings
 from app.models import KnowledgeBase, FileDocument, FileStatus, generate_uuid, DocumentChunk
 from app.schemas import FileUploadResponse, FileStatusResponse, ApiResponse
-from app.tasks.parse_tasks import process_file_parsing
+from app.tasks.parse_tasks import process_file_parsing, adjust_kb_chunk_count
 
 router = APIRouter(tags=["File"])
 settings = get_settings()
@@ -359,12 +360,12 @@ async def delete_file(
         pass
 
     # 删除数据库记录
-    # 级联删除 chunks
-    from app.models import DocumentChunk
-    chunks = session.exec(select(DocumentChunk).where(DocumentChunk.file_id == file_id)).all()
-    for chunk in chunks:
-        session.delete(chunk)
-        
+    # 级联删除 chunks (单条 DELETE，不逐行加载、删除)
+    removed_count = session.exec(
+        delete(DocumentChunk).where(DocumentChunk.file_id == file_id)
+    ).rowcount
+    adjust_kb_chunk_count(session, file_doc.kb_id, -removed_count)
+
     session.delete(file_doc)
     session.commit()
     
@@ -3,6 +3,7 @@
 """
 
 from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy import delete
 from sqlmodel import Session, select, func
 from typing import List
 from datetime import datetime
@@ -93,26 +94,10 @@ async def get_knowledge_base(
             detail={"code": 40401, "message": "知识库不存在"},
         )
 
-    # 获取文件数量
-    files_count = len(
-        session.exec(
-            select(FileDocument).where(FileDocument.kb_id == kb_id)
-        ).all()
-    )
-
-    # 计算 chunk 总数
-    from app.models import DocumentChunk
-    # 查找属于该知识库的所有文件
-    files = session.exec(
-        select(FileDocument).where(FileDocument.kb_id == kb_id)
-    ).all()
-    file_ids = [f.id for f in files]
-    
-    chunk_count = 0
-    if file_ids:
-        chunk_count = session.exec(
-            select(func.count(DocumentChunk.id)).where(DocumentChunk.file_id.in_(file_ids))
-        ).one()
+    # 获取文件数量 (只做 COUNT，不加载文件记录)
+    files_count = session.exec(
+        select(func.count(FileDocument.id)).where(FileDocument.kb_id == kb_id)
+    ).one()
 
     return ApiResponse(
         data=KnowledgeBaseDetailResponse(
@@ -121,7 +106,8 @@ async def get_knowledge_base(
             description=kb.description,
             embedding_model=kb.embedding_model,
             vlm_model=kb.vlm_model,
-            chunk_count=chunk_count,
+            # chunk_count 在分块写入/删除时增量维护，无需再统计
+            chunk_count=kb.chunk_count,
             updated_at=kb.updated_at,
             files_count=files_count,
         )
@@ -190,23 +176,28 @@ async def permanent_delete_knowledge_base(
 
     # 删除数据库记录（手动级联删除文件和 chunks）
     from app.models import DocumentChunk
-    
-    # 获取所有文件
-    files = session.exec(select(FileDocument).where(FileDocument.kb_id == kb_id)).all()
-    for file_doc in files:
-        # 删除物理文件
-        if os.path.exists(file_doc.local_path):
+
+    # 删除物理文件 (只需要文件路径)
+    local_paths = session.exec(select(FileDocument.local_path).where(FileDocument.kb_id == kb_id)).all()
+    for local_path in local_paths:
+        if os.path.exists(local_path):
             try:
-                os.remove(file_doc.local_path)
+                os.remove(local_path)
             except OSError:
                 pass
-        
-        # 删除 chunks
-        chunks = session.exec(select(DocumentChunk).where(DocumentChunk.file_id == file_doc.id)).all()
-        for chunk in chunks:
-            session.delete(chunk)
-            
-        session.delete(file_doc)
+
+    # chunks 与文件记录各用一条 DELETE 删除
+    kb_file_ids = select(FileDocument.id).where(FileDocument.kb_id == kb_id)
+    session.exec(
+        delete(DocumentChunk)
+        .where(DocumentChunk.file_id.in_(kb_file_ids))
+        .execution_options(synchronize_session=False)
+    )
+    session.exec(
+        delete(FileDocument)
+        .where(FileDocument.kb_id == kb_id)
+        .execution_options(synchronize_session=False)
+    )
 
     session.delete(kb)
     session.commit()
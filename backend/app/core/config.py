@@ -15,6 +15,7 @@ class Settings(BaseSettings):
     HOST: str = "0.0.0.0"
     PORT: int = 8000
     ENV: str = "dev"
+    LOG_LEVEL: str = "INFO"
 
     # 数据库与存储
     DATABASE_URL: str = "sqlite:///./local.db"
@@ -27,6 +28,9 @@ class Settings(BaseSettings):
     LLM_BASE_URL: str = "http://localhost:11434/v1"
     LLM_API_KEY: str = "ollama"
     LLM_MODEL: str = "qwen2.5:7b"
+    # 问题改写的语义缓存阈值 (余弦相似度)；0 表示关闭，仅复用完全相同问题的改写结果。
+    # 只差年份、数字或实体的问题相似度也很高，开启时应取很严格的值 (如 0.98)
+    REWRITE_SEMANTIC_THRESHOLD: float = 0.0
 
     # Embedding 配置
     EMBEDDING_BASE_URL: str = "http://localhost:11434/v1"
@@ -38,8 +42,36 @@ class Settings(BaseSettings):
     VLM_API_KEY: str = "ollama"
     VLM_MODEL: str = "llava:7b"
 
+    # TLS 配置 (自签名证书的服务可指定 CA 证书文件，为空时使用 certifi)
+    SSL_CERT_FILE: str = ""
+
     # 任务配置
+    # Celery worker 并发数；任务以等待 VLM/Embedding 接口为主 (I/O 密集)，可取 2 * CPU 核数 + 1
     MAX_PARSING_WORKERS: int = 10
+    # Embedding 接口最大并发请求数 (进程内共享，按服务商限流档位调整；为 0 时使用 16)
+    EMBED_MAX_CONCURRENCY: int = 8
+    # 入库时每个 Embedding 请求的最大条数 (各批并发发送)
+    EMBED_BATCH_SIZE: int = 32
+    # 入库 Embedding 结果在 Redis 中的缓存时间 (秒)，重新提交未修改的分块时直接复用；0 表示不缓存
+    EMBED_CACHE_TTL: int = 7 * 24 * 3600
+    # 向量库单次写入的最大条数 (同时受 Chroma 自身上限限制)
+    VECTOR_ADD_BATCH_SIZE: int = 500
+    # 检索时取回候选向量，以精确余弦相似度作为 score (默认关闭)。
+    # 注意：关闭时 score 为 1 - 距离/2，开启后改为余弦相似度，向量未归一化的模型两者尺度不同，需相应调整 score_threshold
+    VECTOR_EXACT_RESCORE: bool = False
+    # 图片 data URI 进程内缓存的总字节数上限 (每个 API 进程、Celery 子进程各一份)；0 表示不缓存
+    DATA_URI_CACHE_BYTES: int = 32 * 1024 * 1024
+    # 单个 data URI 超过该字节数时不缓存
+    DATA_URI_CACHE_MAX_ITEM_BYTES: int = 2 * 1024 * 1024
+
+    # 本地 Rerank 模型配置
+    RERANK_BATCH_SIZE: int = 32
+    # CPU 推理时对 Linear 层做 int8 动态量化 (分数会有轻微偏差)
+    RERANK_CPU_INT8: bool = False
+    # 推理时的最大 token 数 (与模型 context_length 取较小值)；注意力开销随长度平方增长，0 表示不额外限制
+    RERANK_MAX_LENGTH: int = 512
+    # 每批推理填充后的最大 token 数 (候选按长度排序后分批)，0 表示只按 RERANK_BATCH_SIZE 分批
+    RERANK_TOKEN_BUDGET: int = 8192
 
     # 切分配置
     CHUNK_SIZE: int = 500
@@ -30,12 +30,42 @@ if "sqlite" in settings.DATABASE_URL:
     def set_sqlite_pragma(dbapi_connection, connection_record):
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA journal_mode=WAL")
+        # WAL 模式下 NORMAL 仍能保证数据库一致性 (断电时可能丢失最近的事务)，省去每次提交的 fsync
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA cache_size=-65536")  # 64 MB 页缓存
         cursor.close()
 
 
 def init_db():
     """初始化数据库表"""
     SQLModel.metadata.create_all(engine)
+    reconcile_chunk_counts()
+
+
+def reconcile_chunk_counts():
+    """
+    按 document_chunks 的实际行数校正知识库的 chunk_count
+
+    chunk_count 运行期间随分块写入/删除增量维护；旧版本曾写入向量库条数，
+    应用启动时校正一次 (只更新不一致的行)，运行期间的读取不再需要 COUNT。
+    """
+    from sqlalchemy import func, select, update
+    from app.models import DocumentChunk, FileDocument, KnowledgeBase
+
+    actual = (
+        select(func.count(DocumentChunk.id))
+        .join(FileDocument, DocumentChunk.file_id == FileDocument.id)
+        .where(FileDocument.kb_id == KnowledgeBase.id)
+        .scalar_subquery()
+    )
+    with Session(engine) as session:
+        session.exec(
+            update(KnowledgeBase)
+            .where(KnowledgeBase.chunk_count != actual)
+            .values(chunk_count=actual)
+        )
+        session.commit()
 
 
 def get_session():
@@ -1,14 +1,47 @@
 """
 Rerank 模型加载器 (单例模式)
 """
+import importlib.util
+import logging
+import threading
 from typing import Optional, Any, List, Dict
 
+from app.core.config import get_settings
+
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
+def _length_batches(lengths: List[int], batch_size: int, token_budget: int) -> List[List[int]]:
+    """
+    按长度升序把样本下标分批
+
+    每批最多 batch_size 个，且填充后的 token 数 (条数 * 批内最大长度) 不超过 token_budget
+    (单个样本超出预算时单独成批)；token_budget <= 0 时只按条数分批。
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    for i in sorted(range(len(lengths)), key=lengths.__getitem__):
+        # 升序遍历，加入后的批内最大长度即 lengths[i]
+        if current and (
+            len(current) >= batch_size
+            or (token_budget > 0 and (len(current) + 1) * lengths[i] > token_budget)
+        ):
+            batches.append(current)
+            current = []
+        current.append(i)
+    if current:
+        batches.append(current)
+    return batches
+
+
 class RerankModelLoader:
     _instance = None
     _model = None
     _tokenizer = None
     _current_model_path: Optional[str] = None
     _device = None
+    # 模型加载与推理串行执行：避免并发首次调用重复加载，以及多个前向计算争用同一块 GPU/CPU
+    _lock = threading.RLock()
 
     def __new__(cls):
         if cls._instance is None:
@@ -26,44 +59,83 @@ class RerankModelLoader:
         """
         加载模型。如果模型已经加载且路径一致，则跳过。
         """
+        with self._lock:
+            self._load_model(model_path, max_len)
+
+    def _load_model(self, model_path: str, max_len: int):
         import torch
         from transformers import AutoModelForSequenceClassification, AutoTokenizer
 
         if self._model is not None and self._current_model_path == model_path:
-            print(f"Rerank model {model_path} already loaded.")
+            logger.debug("Rerank model %s already loaded", model_path)
             return
 
-        print(f"Loading rerank model from {model_path} to {self.device}...")
+        logger.info("Loading rerank model from %s to %s", model_path, self.device)
         try:
             self._tokenizer = AutoTokenizer.from_pretrained(model_path, local_files_only=True, trust_remote_code=True)
             dtype = torch.float16 if self.device == "cuda" else torch.float32
-            self._model = AutoModelForSequenceClassification.from_pretrained(
-                model_path, 
-                local_files_only=True, 
-                dtype=dtype,
-                trust_remote_code=True
-            )
+            kwargs = {"local_files_only": True, "dtype": dtype, "trust_remote_code": True}
+            model = None
+            if self.device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+                # GPU 上安装了 flash-attn 时使用 FlashAttention-2 (fp16)，模型不支持时回退到默认实现
+                try:
+                    model = AutoModelForSequenceClassification.from_pretrained(
+                        model_path, attn_implementation="flash_attention_2", **kwargs
+                    )
+                except (ImportError, ValueError) as e:
+                    logger.info("flash_attention_2 unavailable for %s, using default attention: %s", model_path, e)
+            if model is None:
+                model = AutoModelForSequenceClassification.from_pretrained(model_path, **kwargs)
+            self._model = model
             self._model.eval().to(self.device)
+            if self.device == "cpu" and settings.RERANK_CPU_INT8:
+                # Linear 层权重量化为 int8，激活在运行时动态量化 (支持 VNNI 的 CPU 上吞吐明显提升)
+                self._model = torch.ao.quantization.quantize_dynamic(
+                    self._model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+                logger.info("Rerank model quantized to int8 (dynamic)")
             self._current_model_path = model_path
             self._max_len = max_len
-            print("Rerank model loaded successfully!")
-        except Exception as e:
-            print(f"Failed to load rerank model: {e}")
-            raise e
+            logger.info("Rerank model loaded: %s", model_path)
+        except Exception:
+            logger.exception("Failed to load rerank model %s", model_path)
+            raise
 
-    def predict(self, query: str, passages: List[str], model_path: str, max_len: int = 8196) -> List[Dict[str, Any]]:
+    def predict(
+        self,
+        query: str,
+        passages: List[str],
+        model_path: str,
+        max_len: int = 8196,
+        batch_size: Optional[int] = None,
+    ) -> List[Dict[str, Any]]:
         """
         执行推理
         :param query: 查询
         :param passages: 候选文档列表
         :param model_path: 模型路径 (用于检查是否需要重新加载)
         :param max_len: 最大上下文长度
+        :param batch_size: 每批推理的候选数，默认 settings.RERANK_BATCH_SIZE
         :return: 排序结果 [{"index": i, "score": float, "text": str}]
         """
+        with self._lock:
+            return self._predict(query, passages, model_path, max_len, batch_size)
+
+    def _predict(
+        self,
+        query: str,
+        passages: List[str],
+        model_path: str,
+        max_len: int,
+        batch_size: Optional[int],
+    ) -> List[Dict[str, Any]]:
         import torch
         
         # 确保模型已加载
-        self.load_model(model_path, max_len)
+        self._load_model(model_path, max_len)
+        # 截断长度取模型上下文与 RERANK_MAX_LENGTH 的较小值 (注意力开销随长度平方增长)
+        if settings.RERANK_MAX_LENGTH > 0:
+            max_len = min(max_len, settings.RERANK_MAX_LENGTH)
 
         if not self._model or not self._tokenizer:
             raise RuntimeError("Rerank model not initialized")
@@ -77,18 +149,24 @@ class RerankModelLoader:
             
             input_texts = [f"query: {query} document: {doc}" for doc in passages]
             
-            with torch.no_grad():
-                inputs = self._tokenizer(
-                    input_texts, 
-                    padding=True, 
-                    truncation=True, 
-                    return_tensors='pt', 
-                    max_length=max_len
-                ).to(self.device)
-                
-                scores = self._model(**inputs, return_dict=True).logits.view(-1,).float()
-                # 使用 sigmoid 归一化到 0-1
-                scores = torch.sigmoid(scores).cpu().numpy().tolist()
+            # 先整体分词 (不填充) 得到各样本长度，再按长度排序分批：
+            # 长度相近的样本放在同一批，每批只填充到批内最长样本，避免短文档陪着超长文档做填充计算
+            encodings = self._tokenizer(input_texts, truncation=True, max_length=max_len)
+            lengths = [len(ids) for ids in encodings["input_ids"]]
+            batch_size = max(1, batch_size or settings.RERANK_BATCH_SIZE)
+            scores = [0.0] * len(input_texts)
+            with torch.inference_mode():
+                for batch in _length_batches(lengths, batch_size, settings.RERANK_TOKEN_BUDGET):
+                    inputs = self._tokenizer.pad(
+                        [{key: encodings[key][i] for key in encodings.keys()} for i in batch],
+                        padding="longest",
+                        return_tensors='pt',
+                    ).to(self.device)
+
+                    logits = self._model(**inputs, return_dict=True).logits.view(-1,).float()
+                    # 使用 sigmoid 归一化到 0-1，按原始位置写回
+                    for i, score in zip(batch, torch.sigmoid(logits).cpu().tolist()):
+                        scores[i] = score
 
             # 构造结果
             results = []
@@ -103,6 +181,6 @@ class RerankModelLoader:
             results.sort(key=lambda x: x["score"], reverse=True)
             return results
 
-        except Exception as e:
-            print(f"Rerank inference failed: {e}")
-            raise e
+        except Exception:
+            logger.exception("Rerank inference failed (%d passages)", len(passages))
+            raise
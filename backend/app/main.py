@@ -8,14 +8,25 @@ from fastapi.staticfiles import StaticFiles
 from fastapi.responses import JSONResponse
 from fastapi.routing import APIRoute
 from contextlib import asynccontextmanager
+import logging
 import os
 
 from app.core.config import get_settings, ensure_directories
 from app.core.database import init_db
 from app.api import api_router
+from app.services.embedding import EmbeddingService
+from app.services.llm import LLMService
+from app.services.rerank import RerankService
+from app.services.vlm import VLMService
 
 settings = get_settings()
 
+# 日志配置 (只在启动时配置一次)
+logging.basicConfig(
+    level=settings.LOG_LEVEL.upper(),
+    format="%(asctime)s %(levelname)s [%(name)s] %(message)s",
+)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -33,6 +44,11 @@ async def lifespan(app: FastAPI):
 
     yield
     # 关闭时执行
+    await EmbeddingService.aclose()
+    await VLMService.aclose()
+    await LLMService.aclose()
+    await RerankService.aclose()
+    RerankService.close()
     print("应用关闭")
 
 
@@ -4,6 +4,7 @@
 
 from app.services.parser import FileParser, TextSplitter, ParsedChunk
 from app.services.vlm import VLMService
+from app.services.semantic_cache import SemanticCache
 from app.services.embedding import EmbeddingService
 from app.services.vector_store import VectorStoreService
 from app.services.llm import LLMService
@@ -14,6 +15,7 @@ __all__ = [
     "TextSplitter",
     "ParsedChunk",
     "VLMService",
+    "SemanticCache",
     "EmbeddingService",
     "VectorStoreService",
     "LLMService",
@@ -93,7 +93,7 @@ class AgentWorkflow:
         
         # 调用 LLM 进行改写
         try:
-            rewritten = await self.llm_service.rewrite_query(query)
+            rewritten = await self.llm_service.rewrite_query(query, embedding_service=self.embedding_service)
         except:
             rewritten = query
             
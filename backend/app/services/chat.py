@@ -2,7 +2,7 @@
 对话服务 (Agent 实现)
 """
 
-from typing import List, Dict, Any, AsyncGenerator, Tuple
+from typing import List, Dict, Any, AsyncGenerator, Tuple, Optional
 from app.schemas import Message, RecallResult
 from app.services.llm import LLMService
 from app.services.embedding import EmbeddingService
@@ -14,13 +14,44 @@ from app.models import KnowledgeBase, CustomModel
 
 
 import os
-import base64
 import time
+import heapq
 import json
 import re
+import logging
 from app.core.config import get_settings
+from app.utils.image_utils import encode_image_async
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+_CHITCHAT_RE = re.compile(
+    r"^(你好|您好|在吗|在么|谢谢|多谢|感谢|再见|拜拜|好的|嗯|hi|hello|hey|thanks|thank you|ok|bye)[\s!！。.~～]*$",
+    re.IGNORECASE,
+)
+# 闲聊判定的长度上限 (需容纳最长的候选词 "thank you" 及少量标点)
+_CHITCHAT_MAX_LEN = 16
+_QUESTION_RE = re.compile(r"[?？]|如何|怎么|怎样|为什么|为何|是什么|什么是|哪些|多少")
+# 仅对较短的问题直接判定需要检索，较长的问题仍交给 LLM 拆分子问题
+_QUICK_QUESTION_MAX_LEN = 32
+
+
+def _quick_retrieval_intent(message: str) -> Optional[bool]:
+    """
+    意图识别的快速启发式判断
+
+    Returns:
+        False: 明显的闲聊，无需检索
+        True: 简短的明确问题，需要检索
+        None: 无法判断，交给 LLM 识别
+    """
+    text = message.strip()
+    if len(text) <= _CHITCHAT_MAX_LEN and _CHITCHAT_RE.match(text):
+        return False
+    if len(text) <= _QUICK_QUESTION_MAX_LEN and _QUESTION_RE.search(text):
+        return True
+    return None
+
 
 class ChatService:
 # ... (rest of the class)
@@ -48,7 +79,7 @@ class ChatService:
         Agent 模式流式对话 (HyDE -> Rerank -> Generate)
         """
         total_start_time = time.time()
-        print(f"DEBUG_CHAT: Start _chat_stream_agent. TopK: {top_k}", flush=True)
+        logger.debug("Start _chat_stream_agent. TopK: %s", top_k)
 
         # Get user message
         user_message = None
@@ -58,10 +89,12 @@ class ChatService:
                 break
         
         if not user_message:
-            print("DEBUG_CHAT: No user message found")
+            logger.debug("No user message found")
             yield ("error", {"error": "没有找到用户消息"})
             return
 
+        chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
+
         # Prepare LLM Service
         current_llm_service = self.llm_service
         actual_model_id = model_id
@@ -101,36 +134,46 @@ JSON Format:
 """
         intent = "rag"
         sub_questions = [user_message]
-        
-        try:
-            print("DEBUG_CHAT: Requesting intent split...", flush=True)
-            response = await current_llm_service.generate(
-                messages=[{"role": "user", "content": split_prompt}],
-                model_id=actual_model_id
-            )
-            # Try to find JSON in the response
-            json_match = re.search(r'\{.*\}', response, re.DOTALL)
-            if json_match:
-                data = json.loads(json_match.group())
-                intent = data.get("intent", "rag").lower()
-                sub_questions = data.get("sub_questions", [user_message])
-                if not isinstance(sub_questions, list):
-                    sub_questions = [str(sub_questions)]
-                # Ensure max 3
-                sub_questions = sub_questions[:3]
-            
-            yield ("agent_thought", {
-                "step": "decision",
-                "content": f"意图: {intent}, 拆分为 {len(sub_questions)} 个子问题: {sub_questions}",
-                "duration": time.time() - step_start_time
-            })
-        except Exception as e:
-            print(f"DEBUG_CHAT: Split failed: {e}", flush=True)
+
+        quick_intent = _quick_retrieval_intent(user_message)
+        if quick_intent is not None:
+            # 明显的闲聊 / 简短问题，跳过 LLM 意图识别
+            intent = "rag" if quick_intent else "chat"
             yield ("agent_thought", {
                 "step": "decision",
-                "content": "意图识别失败，默认执行全量检索。",
+                "content": f"意图: {intent} (快速判断), 拆分为 {len(sub_questions)} 个子问题: {sub_questions}",
                 "duration": time.time() - step_start_time
             })
+        else:
+            try:
+                logger.debug("Requesting intent split...")
+                response = await current_llm_service.generate(
+                    messages=[{"role": "user", "content": split_prompt}],
+                    model_id=actual_model_id
+                )
+                # Try to find JSON in the response
+                json_match = re.search(r'\{.*\}', response, re.DOTALL)
+                if json_match:
+                    data = json.loads(json_match.group())
+                    intent = data.get("intent", "rag").lower()
+                    sub_questions = data.get("sub_questions", [user_message])
+                    if not isinstance(sub_questions, list):
+                        sub_questions = [str(sub_questions)]
+                    # Ensure max 3
+                    sub_questions = sub_questions[:3]
+            
+                yield ("agent_thought", {
+                    "step": "decision",
+                    "content": f"意图: {intent}, 拆分为 {len(sub_questions)} 个子问题: {sub_questions}",
+                    "duration": time.time() - step_start_time
+                })
+            except Exception as e:
+                logger.warning("Split failed: %s", e)
+                yield ("agent_thought", {
+                    "step": "decision",
+                    "content": "意图识别失败，默认执行全量检索。",
+                    "duration": time.time() - step_start_time
+                })
 
         # Handle Chat Intent
         if intent == "chat":
@@ -140,7 +183,6 @@ JSON Format:
                 "content": "正在直接生成回答..."
              })
              
-             chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
              try:
                 async for chunk in current_llm_service.generate_stream(
                     messages=chat_messages,
@@ -148,7 +190,7 @@ JSON Format:
                 ):
                     yield ("answer_chunk", {"content": chunk})
              except Exception as e:
-                print(f"DEBUG_CHAT: Chat generation failed: {e}")
+                logger.warning("Chat generation failed: %s", e)
                 yield ("error", {"error": f"生成回答失败: {str(e)}"})
              
              total_duration = time.time() - total_start_time
@@ -178,7 +220,7 @@ JSON Format:
                 all_kbs = session.exec(select(KnowledgeBase).where(KnowledgeBase.is_deleted == False)).all()
                 kb_ids = [kb.id for kb in all_kbs]
                 kb_names = [kb.name for kb in all_kbs]
-                print(f"DEBUG_CHAT: Auto-selected KBs: {kb_ids}")
+                logger.debug("Auto-selected KBs: %s", kb_ids)
             else:
                 for kb_id in kb_ids:
                     kb = session.get(KnowledgeBase, kb_id)
@@ -199,10 +241,11 @@ JSON Format:
                             model=custom_model.model_name
                         )
 
-        # Loop through sub-questions
+        # Loop through sub-questions (HyDE + Embed)
+        sub_vectors = []  # [(sub_q, query_vector)]
         for i, sub_q in enumerate(sub_questions):
             step_start_time = time.time()
-            print(f"DEBUG_CHAT: Processing sub-question {i+1}: {sub_q}")
+            logger.debug("Processing sub-question %d: %s", i + 1, sub_q)
             
             # HyDE
             hyde_query = sub_q
@@ -220,33 +263,51 @@ JSON Format:
                         "duration": time.time() - step_start_time
                     })
             except Exception as e:
-                print(f"DEBUG_CHAT: HyDE failed for sub_q {i}: {e}")
+                logger.warning("HyDE failed for sub_q %d: %s", i, e)
             
-            # Embed & Retrieve
+            # Embed
+            try:
+                sub_vectors.append((sub_q, await current_embedding_service.embed_query(hyde_query)))
+            except Exception as e:
+                logger.warning("Embedding failed for sub_q %d: %s", i, e)
+
+        # Retrieve: 每个知识库只检索一次，批量查询所有子问题的向量
+        if sub_vectors:
             try:
-                query_vector = await current_embedding_service.embed_query(hyde_query)
-                
-                # Query all KBs
                 with Session(engine) as session:
                     kb_names_map = {kb.id: kb.name for kb in session.exec(select(KnowledgeBase).where(KnowledgeBase.id.in_(kb_ids))).all()}
-                    
-                    for kb_id in kb_ids:
-                        results = self.vector_service.query(
-                            kb_id=kb_id,
-                            query_vector=query_vector,
-                            top_k=top_k,
-                            score_threshold=score_threshold
-                        )
-                        for r in results:
-                            # Deduplicate
-                            if r["id"] not in seen_ids:
-                                seen_ids.add(r["id"])
-                                r["kb_name"] = kb_names_map.get(kb_id, "未知")
-                                r["kb_id"] = kb_id
-                                r["sub_question"] = sub_q # Track origin
-                                all_results.append(r)
             except Exception as e:
-                print(f"Retrieve failed for sub_q {i}: {e}")
+                logger.warning("Failed to load knowledge base names: %s", e)
+                kb_names_map = {}
+
+            # 单个知识库检索失败 (如向量维度不一致) 只跳过该库，保留其他库的结果
+            query_vectors = [vector for _, vector in sub_vectors]
+            kb_results = {}
+            for kb_id in kb_ids:
+                try:
+                    kb_results[kb_id] = self.vector_service.query_batch(
+                        kb_id=kb_id,
+                        query_vectors=query_vectors,
+                        top_k=top_k,
+                        score_threshold=score_threshold,
+                        exact_rescore=settings.VECTOR_EXACT_RESCORE
+                    )
+                except Exception as e:
+                    logger.warning("Retrieve failed for kb %s (%d sub-questions): %s", kb_id, len(query_vectors), e)
+
+            # 按子问题、知识库的顺序合并，与逐个检索时的去重顺序一致
+            for q, (sub_q, _) in enumerate(sub_vectors):
+                for kb_id in kb_ids:
+                    if kb_id not in kb_results:
+                        continue
+                    for r in kb_results[kb_id][q]:
+                        # Deduplicate
+                        if r["id"] not in seen_ids:
+                            seen_ids.add(r["id"])
+                            r["kb_name"] = kb_names_map.get(kb_id, "未知")
+                            r["kb_id"] = kb_id
+                            r["sub_question"] = sub_q # Track origin
+                            all_results.append(r)
 
         yield ("agent_thought", {
             "step": "action",
@@ -277,7 +338,7 @@ JSON Format:
                      candidates = [r["content"] for r in all_results]
                      # Rerank against ORIGINAL user query (or combined sub-questions?)
                      # Using original user_message is usually best for global relevance.
-                     rerank_results = rerank_service.rerank(user_message, candidates, model=rerank_model)
+                     rerank_results = (await rerank_service.rerank_many([user_message], [candidates], model=rerank_model))[0]
                      
                      if rerank_results:
                          new_results = []
@@ -291,7 +352,7 @@ JSON Format:
                                      new_results.append(item)
                          final_results = new_results
                  except Exception as e:
-                     print(f"DEBUG_CHAT: Rerank failed: {e}")
+                     logger.warning("Rerank failed: %s", e)
              
              yield ("agent_thought", {
                 "step": "decision",
@@ -301,11 +362,9 @@ JSON Format:
 
         # Sort and Slice
         if rerank_enabled and final_results and "rerank_score" in final_results[0]:
-            final_results.sort(key=lambda x: x.get("rerank_score", 0), reverse=True)
+            final_results = heapq.nlargest(top_k, final_results, key=lambda x: x.get("rerank_score", 0))
         else:
-            final_results.sort(key=lambda x: x["score"], reverse=True)
-            
-        final_results = final_results[:top_k] # Use top_k
+            final_results = heapq.nlargest(top_k, final_results, key=lambda x: x["score"])
 
         # Send RAG Result
         def format_citation(r):
@@ -353,8 +412,6 @@ JSON Format:
 3. 适当引用来源（如"根据文档..."）
 4. 使用中文回答"""
 
-        chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
-        
         # Multimodal (Images)
         retrieved_images = []
         for r in all_results: 
@@ -363,12 +420,8 @@ JSON Format:
                  full_image_path = os.path.join(settings.IMAGE_DIR, img_path)
                  if os.path.exists(full_image_path):
                      try:
-                         with open(full_image_path, "rb") as img_file:
-                             encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
-                             ext = os.path.splitext(img_path)[1].lower().replace('.', '')
-                             if not ext: ext = 'jpeg'
-                             if ext == 'jpg': ext = 'jpeg'
-                             retrieved_images.append(f"data:image/{ext};base64,{encoded_string}")
+                         data_uri = await encode_image_async(full_image_path)
+                         retrieved_images.append(data_uri)
                      except: pass
 
         if retrieved_images and chat_messages:
@@ -388,7 +441,7 @@ JSON Format:
             ):
                 yield ("answer_chunk", {"content": chunk})
         except Exception as e:
-            print(f"DEBUG_CHAT: Chat generation failed: {e}")
+            logger.warning("Chat generation failed: %s", e)
             yield ("error", {"error": f"生成回答失败: {str(e)}"})
             return
 
@@ -419,7 +472,7 @@ JSON Format:
         不进行意图识别、不进行 HyDE、不自动选择所有知识库。
         """
         total_start_time = time.time()
-        print(f"DEBUG_CHAT: Start _chat_stream_normal. Messages: {len(messages)}, KBs: {kb_ids}, TopK: {top_k}", flush=True)
+        logger.debug("Start _chat_stream_normal. Messages: %d, KBs: %s, TopK: %s", len(messages), kb_ids, top_k)
 
         # Get user message
         user_message = None
@@ -432,6 +485,8 @@ JSON Format:
             yield ("error", {"message": "没有找到用户消息"})
             return
 
+        chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
+
         # Prepare LLM Service
         current_llm_service = self.llm_service
         actual_model_id = model_id
@@ -453,7 +508,6 @@ JSON Format:
                 "content": "未指定知识库，正在直接生成回答..."
              })
              
-             chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
              try:
                 async for chunk in current_llm_service.generate_stream(
                     messages=chat_messages,
@@ -461,7 +515,7 @@ JSON Format:
                 ):
                     yield ("answer_chunk", {"content": chunk})
              except Exception as e:
-                print(f"DEBUG_CHAT: Chat generation failed: {e}")
+                logger.warning("Chat generation failed: %s", e)
                 yield ("error", {"error": f"生成回答失败: {str(e)}"})
              
              total_duration = time.time() - total_start_time
@@ -513,7 +567,8 @@ JSON Format:
                     kb_id=kb_id,
                     query_vector=query_vector,
                     top_k=top_k,
-                    score_threshold=score_threshold
+                    score_threshold=score_threshold,
+                    exact_rescore=settings.VECTOR_EXACT_RESCORE
                 )
                 for r in results:
                     # Deduplicate
@@ -523,7 +578,7 @@ JSON Format:
                         r["kb_id"] = kb_id
                         all_results.append(r)
         except Exception as e:
-            print(f"Retrieve failed: {e}")
+            logger.warning("Retrieve failed: %s", e)
             yield ("error", {"error": f"检索失败: {str(e)}"})
             return
 
@@ -555,7 +610,7 @@ JSON Format:
                         rerank_model = session.get(CustomModel, rerank_model_id)
 
                      candidates = [r["content"] for r in all_results]
-                     rerank_results = rerank_service.rerank(user_message, candidates, model=rerank_model)
+                     rerank_results = (await rerank_service.rerank_many([user_message], [candidates], model=rerank_model))[0]
                      
                      if rerank_results:
                          new_results = []
@@ -569,7 +624,7 @@ JSON Format:
                                      new_results.append(item)
                          final_results = new_results
                  except Exception as e:
-                     print(f"DEBUG_CHAT: Rerank failed: {e}")
+                     logger.warning("Rerank failed: %s", e)
              
              yield ("agent_thought", {
                 "step": "decision",
@@ -579,11 +634,9 @@ JSON Format:
 
         # Sort and Slice
         if rerank_enabled and final_results and "rerank_score" in final_results[0]:
-            final_results.sort(key=lambda x: x.get("rerank_score", 0), reverse=True)
+            final_results = heapq.nlargest(top_k, final_results, key=lambda x: x.get("rerank_score", 0))
         else:
-            final_results.sort(key=lambda x: x["score"], reverse=True)
-            
-        final_results = final_results[:top_k]
+            final_results = heapq.nlargest(top_k, final_results, key=lambda x: x["score"])
 
         # Send RAG Result
         def format_citation(r):
@@ -631,8 +684,6 @@ JSON Format:
 3. 适当引用来源（如"根据文档..."）
 4. 使用中文回答"""
 
-        chat_messages = [{"role": msg.role.value, "content": msg.content} for msg in messages]
-        
         # Multimodal (Images)
         retrieved_images = []
         for r in all_results: 
@@ -641,12 +692,8 @@ JSON Format:
                  full_image_path = os.path.join(settings.IMAGE_DIR, img_path)
                  if os.path.exists(full_image_path):
                      try:
-                         with open(full_image_path, "rb") as img_file:
-                             encoded_string = base64.b64encode(img_file.read()).decode('utf-8')
-                             ext = os.path.splitext(img_path)[1].lower().replace('.', '')
-                             if not ext: ext = 'jpeg'
-                             if ext == 'jpg': ext = 'jpeg'
-                             retrieved_images.append(f"data:image/{ext};base64,{encoded_string}")
+                         data_uri = await encode_image_async(full_image_path)
+                         retrieved_images.append(data_uri)
                      except: pass
 
         if retrieved_images and chat_messages:
@@ -666,7 +713,7 @@ JSON Format:
             ):
                 yield ("answer_chunk", {"content": chunk})
         except Exception as e:
-            print(f"DEBUG_CHAT: Chat generation failed: {e}")
+            logger.warning("Chat generation failed: %s", e)
             yield ("error", {"error": f"生成回答失败: {str(e)}"})
             return
 
@@ -696,9 +743,7 @@ JSON Format:
         """
         流式对话
         """
-        import sys
-        print(f"DEBUG_CHAT: Start chat_stream. Messages count: {len(messages)}, KBs: {kb_ids}, Mode: {mode}, TopK: {top_k}", flush=True)
-        sys.stdout.flush()
+        logger.debug("Start chat_stream. Messages count: %d, KBs: %s, Mode: %s, TopK: %s", len(messages), kb_ids, mode, top_k)
 
         if mode == "agent":
             async for item in self._chat_stream_agent(
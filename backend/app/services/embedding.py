@@ -2,34 +2,276 @@
 Embedding 服务
 """
 
+import asyncio
+import certifi
 import httpx
-from typing import List
-import base64
+import logging
+import numpy as np
+import orjson
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, List, Dict, Any, Optional, Tuple, Union
 import os
+import re
+import ssl
 
 from app.core.config import get_settings
+from app.services.semantic_cache import SemanticCache
+from app.utils import HTTP2_AVAILABLE
+from app.utils.async_utils import loop_local
+from app.utils.image_utils import encode_image_async
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# TLS 校验使用固定的 CA 证书文件 (自签名证书的服务可通过 SSL_CERT_FILE 指定)，
+# 进程内只构建一次 SSLContext，各事件循环的客户端共用
+_SSL_CONTEXT = ssl.create_default_context(cafile=settings.SSL_CERT_FILE or certifi.where())
+
+# 旧版图片占位符 [图片: xxx]
+_IMG_RE = re.compile(r"\[图片: (.+)\]\Z", re.S)
+
+# Doubao 多模态接口探测多样本批次时使用的批大小
+_DOUBAO_PROBE_BATCH_SIZE = 8
+# 探测时视为"明确不支持多样本批次"的状态码 (请求内容被拒绝)；超时、限流、5xx 等不在此列
+_DOUBAO_BATCH_REJECT_STATUS = {400, 413, 422}
+
+# Embedding 输入项：纯文本，或结构化的图片输入 {"type": "image", "path": "...", "text": "..."}
+# path 为相对于 IMAGE_DIR 的图片路径，text 为图片块的文本内容 (非多模态接口使用)
+EmbedInput = Union[str, Dict[str, str]]
+
+
+def _input_text(item: EmbedInput) -> str:
+    """获取输入项的文本表示"""
+    if isinstance(item, dict):
+        return item.get("text") or f"[图片: {item.get('path', '')}]"
+    return item
+
+
+def _dedupe_key(item: EmbedInput) -> Any:
+    """批内去重使用的键，空白文本统一映射为单个空格"""
+    if isinstance(item, dict):
+        return (item.get("type"), item.get("path"), item.get("text"))
+    return item if item.strip() else " "
+
+
+@lru_cache(maxsize=None)
+def _doubao_url_for(base_url: str) -> str:
+    """获取 Doubao 多模态 Embedding 的完整 endpoint (每个 base_url 只计算一次)"""
+    # 官方示例 URL 是完整的，不需要加 /embeddings 后缀
+    # 如果 base_url 已经包含了 /embeddings/multimodal，则直接使用
+    if "volces.com" in base_url and not base_url.endswith("/embeddings/multimodal"):
+        # 如果用户只填了 base (e.g., https://ark.cn-beijing.volces.com/api/v3)，则补全
+        return f"{base_url.rstrip('/')}/embeddings/multimodal"
+    return base_url
+
+
+def _summarize_doubao_input(final_input: List[Any]) -> str:
+    """生成 Doubao 请求 input 的脱敏摘要 (不复制 payload，图片只记录 data URI 长度)"""
+    samples = final_input if final_input and isinstance(final_input[0], list) else [final_input]
+    parts = []
+    for sample in samples:
+        items = []
+        for item in sample:
+            if item.get("type") == "image_url":
+                items.append(f"image({len(item.get('image_url', {}).get('url', ''))} chars)")
+            else:
+                items.append(f"text({item.get('text', '')[:30]!r})")
+        parts.append("[" + ", ".join(items) + "]")
+    return f"{len(samples)} sample(s): " + ", ".join(parts)
 
 
 class EmbeddingService:
     """Embedding 服务"""
 
-    def __init__(self, base_url: str = None, api_key: str = None, model: str = None):
+    # Doubao 多模态接口的批大小探测结果 {(url, model): batch_size}
+    _doubao_batch_sizes: Dict[Tuple[str, str], int] = {}
+
+    # embed_query 结果的 LRU 缓存 {(base_url, model, text): embedding} 及进行中的请求
+    # 向量以 float16 数组存放 (约为 Python float 列表内存的 1/14)，取出时再转回列表
+    _QUERY_CACHE_MAX = 2048
+    _query_cache: "OrderedDict[Tuple[str, str, str], np.ndarray]" = OrderedDict()
+    _query_inflight: Dict[Tuple[str, str, str], "asyncio.Future"] = {}
+
+    # 所有 Embedding 请求共享的并发信号量，限制同时在途的请求数以避免触发上游限流 (429)。
+    # asyncio 原语绑定事件循环，因此按事件循环分别创建
+    _sems: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+
+    # 共享的 HTTP 客户端 (HTTP/2 多路复用 + keep-alive)，同样按事件循环分别创建
+    _clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
+    def __init__(
+        self,
+        base_url: str = None,
+        api_key: str = None,
+        model: str = None,
+    ):
         self.base_url = base_url or settings.EMBEDDING_BASE_URL
         self.api_key = api_key or settings.EMBEDDING_API_KEY
         self.model = model or settings.EMBEDDING_MODEL
 
     async def embed_query(self, text: str, model_id: str = None) -> List[float]:
-        """获取文本的向量表示"""
-        embeddings = await self._embed([text], model_id)
+        """获取文本的向量表示 (带 LRU 缓存，相同查询并发请求时只调用一次接口)"""
+        key = (self.base_url, model_id or self.model, text)
+        cached = self._query_cache.get(key)
+        if cached is not None:
+            self._query_cache.move_to_end(key)
+            return cached.astype(np.float32).tolist()
+
+        task = self._query_inflight.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            task = asyncio.ensure_future(self._embed([text], model_id))
+            self._query_inflight[key] = task
+            task.add_done_callback(lambda t: self._on_query_done(key, t))
+
+        # shield: 某个调用方被取消时，不影响其他等待同一请求的调用方
+        embeddings = await asyncio.shield(task)
         return embeddings[0] if embeddings else []
 
-    async def embed_documents(self, texts: List[str], model_id: str = None) -> List[List[float]]:
-        """批量获取文本的向量表示"""
-        return await self._embed(texts, model_id)
+    async def semantic_lookup(
+        self, text: str, cache: SemanticCache, model_id: str = None
+    ) -> Tuple[List[float], Optional[Any]]:
+        """
+        获取查询向量，并在语义缓存中查找相近查询对应的缓存值
+        (一个缓存实例只应对应一个 Embedding 模型)
+
+        Returns:
+            (查询向量, 命中的缓存值或 None)
+        """
+        vector = await self.embed_query(text, model_id)
+        if not vector:
+            return vector, None
+        return vector, cache.get(vector)
+
+    @classmethod
+    def _on_query_done(cls, key: Tuple[str, str, str], task: "asyncio.Future") -> None:
+        """查询请求完成：移出进行中列表，成功时写入 LRU 缓存"""
+        if cls._query_inflight.get(key) is task:
+            del cls._query_inflight[key]
+        if task.cancelled() or task.exception() is not None:
+            return
+
+        embeddings = task.result()
+        if embeddings:
+            cls._query_cache[key] = np.asarray(embeddings[0], dtype=np.float16)
+            cls._query_cache.move_to_end(key)
+            while len(cls._query_cache) > cls._QUERY_CACHE_MAX:
+                cls._query_cache.popitem(last=False)
 
-    async def _embed(self, texts: List[str], model_id: str = None) -> List[List[float]]:
+    @classmethod
+    def _semaphore(cls) -> asyncio.Semaphore:
+        return loop_local(cls._sems, lambda: asyncio.Semaphore(settings.EMBED_MAX_CONCURRENCY or 16))
+
+    @classmethod
+    def _http_client(cls) -> httpx.AsyncClient:
+        return loop_local(
+            cls._clients,
+            lambda: httpx.AsyncClient(
+                timeout=120.0,
+                verify=_SSL_CONTEXT,
+                trust_env=False,  # 显式禁用代理
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            ),
+        )
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """关闭当前事件循环的共享 HTTP 客户端 (应用关闭时调用)"""
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    async def embed_documents(
+        self,
+        texts: List[EmbedInput],
+        model_id: str = None,
+        batch_size: int = None,
+        on_progress: Callable[[int, int], None] = None,
+    ) -> List[List[float]]:
+        """
+        批量获取文本的向量表示
+
+        Args:
+            texts: 文本或图片输入列表
+            model_id: 模型名称
+            batch_size: 每个请求的最大条数，为空时一次请求全部；
+                分批时各批并发请求 (并发数受 EMBED_MAX_CONCURRENCY 限制)
+            on_progress: 每批完成后回调 (已完成条数, 总条数)，按去重后的条数计
+        """
+        return await self._embed(texts, model_id, batch_size, on_progress, blank_as_zero=True)
+
+    async def _embed(
+        self,
+        texts: List[EmbedInput],
+        model_id: str = None,
+        batch_size: int = None,
+        on_progress: Callable[[int, int], None] = None,
+        blank_as_zero: bool = False,
+    ) -> List[List[float]]:
+        """
+        调用 Embedding API (批内去重：重复输入与空白文本只请求一次，结果按原顺序展开)
+
+        blank_as_zero 为 True 时空白文本不请求接口，直接返回零向量 (入库时空白分块没有可检索的语义)
+        """
+        unique: Dict[Any, int] = {}
+        unique_texts: List[EmbedInput] = []
+        positions = []
+        for item in texts:
+            key = _dedupe_key(item)
+            if blank_as_zero and key == " ":
+                positions.append(-1)
+                continue
+            idx = unique.get(key)
+            if idx is None:
+                idx = unique[key] = len(unique_texts)
+                unique_texts.append(" " if key == " " else item)
+            positions.append(idx)
+
+        if len(unique_texts) == len(texts):
+            return await self._embed_batched(unique_texts, model_id, batch_size, on_progress)
+
+        # 全部为空白时仍需请求一次，以确定零向量的维度
+        vectors = await self._embed_batched(unique_texts or [" "], model_id, batch_size, on_progress)
+        zero = [0.0] * len(vectors[0]) if vectors else []
+        return [vectors[idx] if idx >= 0 else zero for idx in positions]
+
+    async def _embed_batched(
+        self,
+        texts: List[EmbedInput],
+        model_id: str,
+        batch_size: Optional[int],
+        on_progress: Optional[Callable[[int, int], None]],
+    ) -> List[List[float]]:
+        """按 batch_size 拆分后并发请求，结果按原顺序拼接"""
+        total = len(texts)
+        if not batch_size or total <= batch_size:
+            vectors = await self._embed_unique(texts, model_id)
+            if on_progress:
+                on_progress(total, total)
+            return vectors
+
+        done = 0
+
+        async def run(batch: List[EmbedInput]) -> List[List[float]]:
+            nonlocal done
+            vectors = await self._embed_unique(batch, model_id)
+            done += len(batch)
+            if on_progress:
+                on_progress(done, total)
+            return vectors
+
+        tasks = [asyncio.ensure_future(run(texts[i:i + batch_size])) for i in range(0, total, batch_size)]
+        try:
+            results = await asyncio.gather(*tasks)
+        except BaseException:
+            # 任一批失败时取消其余批次，避免请求在事件循环关闭后仍处于挂起状态
+            for task in tasks:
+                task.cancel()
+            raise
+        return [vector for vectors in results for vector in vectors]
+
+    async def _embed_unique(self, texts: List[EmbedInput], model_id: str = None) -> List[List[float]]:
         """调用 Embedding API"""
         target_model = model_id or self.model
         
@@ -42,230 +284,222 @@ class EmbeddingService:
 
         url = f"{self.base_url}/embeddings"
         
-        # 打印调试信息
-        print(f"DEBUG_EMBED: Requesting {url}")
-        print(f"DEBUG_EMBED: Model: {target_model}")
-        print(f"DEBUG_EMBED: Text Count: {len(texts)}")
-        if self.api_key:
-            masked_key = self.api_key[:6] + "***" + self.api_key[-4:] if len(self.api_key) > 10 else "***"
-            print(f"DEBUG_EMBED: API Key: {masked_key}")
-        else:
-             print("DEBUG_EMBED: API Key: None")
+        logger.debug("Requesting %s (model=%s, texts=%d)", url, target_model, len(texts))
 
         try:
-            # 增加超时时间，并关闭 verify，禁用环境变量（代理）
-            async with httpx.AsyncClient(timeout=60.0, verify=False, trust_env=False) as client:
+            client = self._http_client()
+            async with self._semaphore():
                 response = await client.post(
                     url,
                     headers={
                         "Authorization": f"Bearer {self.api_key}",
                         "Content-Type": "application/json",
                     },
-                    json={
+                    content=orjson.dumps({
                         "model": target_model,
-                        "input": texts,
-                    },
+                        "input": [_input_text(t) for t in texts],
+                    }),
+                    timeout=60.0,
                 )
 
-                if response.status_code != 200:
-                    print(f"DEBUG_EMBED: Error Status: {response.status_code}")
-                    print(f"DEBUG_EMBED: Error Body: {response.text}")
-                    # 如果是 404，可能是路径不对，尝试一下 doubao 逻辑（作为 fallback）
-                    if response.status_code == 404 and "volces" in (self.base_url or ""):
-                         print("DEBUG_EMBED: 404 detected, retrying with Doubao format...")
-                         return await self._embed_doubao(texts, target_model)
-                    
-                    raise Exception(f"Embedding API 错误: {response.text}")
-
-                result = response.json()
-                # 按 index 排序确保顺序正确
-                embeddings = sorted(result["data"], key=lambda x: x["index"])
-                return [e["embedding"] for e in embeddings]
+            if response.status_code != 200:
+                logger.warning("Embedding API error %s: %s", response.status_code, response.text)
+                # 如果是 404，可能是路径不对，尝试一下 doubao 逻辑（作为 fallback）
+                if response.status_code == 404 and "volces" in (self.base_url or ""):
+                     logger.info("404 detected, retrying with Doubao format")
+                     return await self._embed_doubao(texts, target_model)
+                
+                raise Exception(f"Embedding API 错误: {response.text}")
+
+            result = orjson.loads(response.content)
+            # 按 index 直接写回对应位置，确保顺序正确
+            embeddings = [None] * len(result["data"])
+            for item in result["data"]:
+                embeddings[item["index"]] = item["embedding"]
+            return embeddings
 
         except Exception as e:
-            print(f"DEBUG_EMBED: Exception: {e}")
+            logger.warning("Embedding request failed: %s", e)
             raise
 
-    async def _embed_doubao(self, texts: List[str], model_id: str) -> List[List[float]]:
+    async def _embed_doubao(self, texts: List[EmbedInput], model_id: str) -> List[List[float]]:
         """调用 Doubao (Volcengine) Embedding API"""
-        # 官方示例 URL 是完整的，不需要加 /embeddings 后缀
-        # 如果 base_url 已经包含了 /embeddings/multimodal，则直接使用
-        url = self.base_url
-        
-        # 严格检查 URL 是否为完整的 endpoint
-        if "volces.com" in url and not url.endswith("/embeddings/multimodal"):
-             # 如果用户只填了 base (e.g., https://ark.cn-beijing.volces.com/api/v3)，则补全
-             url = f"{url.rstrip('/')}/embeddings/multimodal"
-        
-        print(f"DEBUG_EMBED_DOUBAO: Requesting {url}")
-        
+        url = _doubao_url_for(self.base_url)
+        logger.debug("Requesting Doubao %s (model=%s, texts=%d)", url, model_id, len(texts))
+
+        # Doubao Multimodal API 可能只接受单样本请求：首次调用时用一个多样本批次探测，
+        # 成功则后续按该批大小请求，否则退回逐条请求。探测结果按 (url, model) 缓存在类上
+        cache_key = (url, model_id)
+        batch_size = self._doubao_batch_sizes.get(cache_key)
         embeddings = []
-        
-        # 使用 requests 替代 httpx 以避免 InvalidURL: URL too long 问题
-        # 这是一个临时的同步调用，运行在 Celery 线程中是可以接受的
-        import requests
-        import copy
-
-        # Process in batches (Doubao Multimodal API might require single item per request, so default to 1)
-        batch_size = 1
-        total_texts = len(texts)
-        
-        for i in range(0, total_texts, batch_size):
-            batch_texts = texts[i : i + batch_size]
-            print(f"DEBUG_EMBED_DOUBAO: Processing batch {i // batch_size + 1}/{(total_texts + batch_size - 1) // batch_size}, size={len(batch_texts)}")
-            
-            batch_input = []
-            
-            for text in batch_texts:
-                # 构造 Doubao 格式 input (单个样本)
-                # 检查 text 是否包含图片占位符 [图片: xxx]
-                sample_input = []
-                
-                if text.startswith("[图片: ") and text.endswith("]"):
-                     # 提取图片路径
-                     image_path_str = text[5:-1]
-                     
-                     # 构造完整路径 (假设图片存储在 settings.IMAGE_DIR)
-                     full_image_path = os.path.join(settings.IMAGE_DIR, image_path_str)
-                     
-                     if os.path.exists(full_image_path):
-                         try:
-                             with open(full_image_path, "rb") as image_file:
-                                 encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-                                 
-                                 # 获取扩展名以确定 mime type
-                                 ext = os.path.splitext(image_path_str)[1].lower().replace('.', '')
-                                 if ext == 'jpg': ext = 'jpeg'
-                                 if not ext: ext = 'png'
-                                 
-                                 data_uri = f"data:image/{ext};base64,{encoded_string}"
-                                 
-                                 sample_input.append({
-                                     "type": "image_url", 
-                                     "image_url": {
-                                         "url": data_uri
-                                     }
-                                 })
-                         except Exception as img_err:
-                             print(f"DEBUG_EMBED_DOUBAO: Image processing failed: {img_err}")
-                             # Fallback to text if image fails
-                             sample_input.append({"type": "text", "text": text})
-                     else:
-                         print(f"DEBUG_EMBED_DOUBAO: Image not found at {full_image_path}")
-                         sample_input.append({"type": "text", "text": text})
+        start = 0
+
+        # 各批次并发请求，由共享信号量限制同时在途的请求数
+        client = self._http_client()
+        if batch_size is None:
+            if len(texts) < 2:
+                batch_size = 1
+            else:
+                probe_texts = texts[:_DOUBAO_PROBE_BATCH_SIZE]
+                # 只有明确的结果才缓存：批次成功，或服务端拒绝了多样本请求
+                conclusive = True
+                try:
+                    probe_embeddings = await self._post_doubao_batch(client, url, model_id, probe_texts, 0, 1)
+                except httpx.HTTPStatusError as e:
+                    probe_embeddings = None
+                    conclusive = e.response.status_code in _DOUBAO_BATCH_REJECT_STATUS
+                except Exception:
+                    # 网络错误等临时故障：本次退回逐条请求，下次调用重新探测
+                    probe_embeddings = None
+                    conclusive = False
+
+                if probe_embeddings is not None and len(probe_embeddings) == len(probe_texts):
+                    batch_size = _DOUBAO_PROBE_BATCH_SIZE
+                    embeddings = probe_embeddings
+                    start = len(probe_texts)
                 else:
-                     clean_text = text.strip()
-                     if not clean_text:
-                         clean_text = " " 
-                     
-                     sample_input.append({"type": "text", "text": clean_text})
-                
-                batch_input.append(sample_input)
+                    batch_size = 1
+                if conclusive:
+                    logger.info("Probed Doubao batch size for %s: %s", model_id, batch_size)
+                    self._doubao_batch_sizes[cache_key] = batch_size
+                else:
+                    logger.info("Doubao batch probe for %s was inconclusive, not caching", model_id)
 
-            # 发送批量请求
-            try:
-                # 如果 batch_size 为 1，解包一层 list，因为 API 可能不接受 List[List[Dict]]
-                final_input = batch_input
-                if len(batch_input) == 1:
-                    final_input = batch_input[0]
-
-                payload = {
-                    "model": model_id,
-                    "input": final_input
-                }
-                
-                # 打印调试信息：Payload (脱敏处理)
-                debug_payload = copy.deepcopy(payload)
-                if "input" in debug_payload:
-                    # 如果是 list of list
-                    if isinstance(debug_payload["input"], list) and len(debug_payload["input"]) > 0 and isinstance(debug_payload["input"][0], list):
-                         debug_input = []
-                         for sample in debug_payload["input"]:
-                             debug_sample = []
-                             for item in sample:
-                                 if item.get("type") == "image_url":
-                                     url_val = item.get("image_url", {}).get("url", "")
-                                     if len(url_val) > 50:
-                                         debug_sample.append({
-                                             "type": "image_url",
-                                             "image_url": {"url": url_val[:50] + "...(truncated)"}
-                                         })
-                                     else:
-                                         debug_sample.append(item)
-                                 else:
-                                     debug_sample.append(item)
-                             debug_input.append(debug_sample)
-                         debug_payload["input"] = debug_input
-                    # 如果是 list of dict (single item unwrapped)
-                    elif isinstance(debug_payload["input"], list):
-                         debug_sample = []
-                         for item in debug_payload["input"]:
-                             if item.get("type") == "image_url":
-                                 url_val = item.get("image_url", {}).get("url", "")
-                                 if len(url_val) > 50:
-                                     debug_sample.append({
-                                         "type": "image_url",
-                                         "image_url": {"url": url_val[:50] + "...(truncated)"}
-                                     })
-                                 else:
-                                     debug_sample.append(item)
-                             else:
-                                 debug_sample.append(item)
-                         debug_payload["input"] = debug_sample
-                
-                # print(f"DEBUG_EMBED_DOUBAO: Payload (Batch): {debug_payload}")
+        # 多样本批次按文本长度排序后再切分，长度相近的输入同批，减少服务端补齐
+        order = list(range(start, len(texts)))
+        if batch_size > 1:
+            order.sort(key=lambda i: len(_input_text(texts[i])))
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        results = await asyncio.gather(
+            *[
+                self._post_doubao_batch(client, url, model_id, [texts[i] for i in batch], idx, len(batches))
+                for idx, batch in enumerate(batches)
+            ],
+            return_exceptions=True,
+        )
+
+        # 所有批次结束后再抛出异常，单个批次失败不会中断其他在途请求
+        embeddings.extend([None] * len(order))
+        for batch, result in zip(batches, results):
+            if isinstance(result, BaseException):
+                raise result
+            if len(result) != len(batch):
+                raise Exception(f"Doubao Embedding 返回数量不匹配: 期望 {len(batch)}, 实际 {len(result)}")
+            for i, vector in zip(batch, result):
+                embeddings[i] = vector
+
+        return embeddings
+
+    async def _post_doubao_batch(
+        self,
+        client: httpx.AsyncClient,
+        url: str,
+        model_id: str,
+        batch_texts: List[EmbedInput],
+        batch_idx: int,
+        batch_count: int,
+    ) -> List[List[float]]:
+        """发送单个 Doubao 批次请求，返回该批次的向量 (顺序与输入一致)"""
+        logger.debug("Processing Doubao batch %d/%d, size=%d", batch_idx + 1, batch_count, len(batch_texts))
+
+        batch_input = await asyncio.gather(*(self._build_doubao_sample(text) for text in batch_texts))
+        embeddings = []
 
-                response = requests.post(
+        # 发送批量请求
+        try:
+            # 单样本时解包一层 list，因为 API 可能不接受 List[List[Dict]]
+            final_input = batch_input
+            if len(batch_input) == 1:
+                final_input = batch_input[0]
+
+            payload = {
+                "model": model_id,
+                "input": final_input
+            }
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Doubao payload: %s", _summarize_doubao_input(final_input))
+
+            async with self._semaphore():
+                response = await client.post(
                     url,
                     headers={
                         "Authorization": f"Bearer {self.api_key}",
                         "Content-Type": "application/json",
                     },
-                    json=payload,
-                    timeout=120.0, 
-                    verify=False,
-                    proxies={"http": None, "https": None} # 显式禁用代理
+                    content=orjson.dumps(payload),
                 )
 
-                if response.status_code != 200:
-                    print(f"DEBUG_EMBED_DOUBAO: Error Status: {response.status_code}")
-                    print(f"DEBUG_EMBED_DOUBAO: Error Body: {response.text}")
-                    raise Exception(f"Doubao API Error ({response.status_code}): {response.text}")
-                
-                result = response.json()
+            if response.status_code != 200:
+                logger.warning("Doubao API error %s: %s", response.status_code, response.text)
+                raise httpx.HTTPStatusError(
+                    f"Doubao API Error ({response.status_code}): {response.text}",
+                    request=response.request,
+                    response=response,
+                )
+            
+            result = orjson.loads(response.content)
+            
+            if "data" in result:
+                data_field = result["data"]
                 
-                if "data" in result:
-                    data_field = result["data"]
-                    
-                    # 情况1: 返回 List (标准 Batch)
-                    if isinstance(data_field, list):
-                         if len(data_field) > 0 and "index" in data_field[0]:
-                             data_field.sort(key=lambda x: x["index"])
-                         
-                         for item in data_field:
-                             if "embedding" in item:
-                                 embeddings.append(item["embedding"])
-                             else:
-                                 print(f"DEBUG_EMBED_DOUBAO: Item missing embedding: {item}")
-                                 raise Exception("Doubao API response item missing embedding")
-                    
-                    # 情况2: 返回 Dict (Single Item)
-                    elif isinstance(data_field, dict):
-                         if "embedding" in data_field:
-                             embeddings.append(data_field["embedding"])
+                # 情况1: 返回 List (标准 Batch)
+                if isinstance(data_field, list):
+                     # 带 index 时按 index 直接写回对应位置
+                     has_index = len(data_field) > 0 and "index" in data_field[0]
+                     embeddings = [None] * len(data_field)
+                     for pos, item in enumerate(data_field):
+                         if "embedding" in item:
+                             embeddings[item["index"] if has_index else pos] = item["embedding"]
                          else:
-                             print(f"DEBUG_EMBED_DOUBAO: Data dict missing embedding: {data_field}")
-                             raise Exception("Doubao API response data missing embedding")
-                    
-                    else:
-                         print(f"DEBUG_EMBED_DOUBAO: Unexpected data structure: {type(data_field)}")
-                         raise Exception("Doubao API response format error: data is not list or dict")
+                             logger.warning("Doubao response item missing embedding: %s", item)
+                             raise Exception("Doubao API response item missing embedding")
+                
+                # 情况2: 返回 Dict (Single Item)
+                elif isinstance(data_field, dict):
+                     if "embedding" in data_field:
+                         embeddings.append(data_field["embedding"])
+                     else:
+                         logger.warning("Doubao response data missing embedding: %s", data_field)
+                         raise Exception("Doubao API response data missing embedding")
+                
                 else:
-                    print(f"DEBUG_EMBED_DOUBAO: Invalid Response Format (missing 'data'): {result}")
-                    raise Exception("Doubao API response format error: missing data")
-                    
-            except Exception as e:
-                print(f"DEBUG_EMBED_DOUBAO: Failed for batch: {e}")
-                raise e
-        
+                     logger.warning("Unexpected Doubao data structure: %s", type(data_field))
+                     raise Exception("Doubao API response format error: data is not list or dict")
+            else:
+                logger.warning("Invalid Doubao response format (missing 'data'): %s", result)
+                raise Exception("Doubao API response format error: missing data")
+                
+        except Exception as e:
+            logger.warning("Doubao batch failed: %s", e)
+            raise e
+
         return embeddings
+
+    async def _build_doubao_sample(self, item: EmbedInput) -> List[Dict[str, Any]]:
+        """构造 Doubao 格式的单个样本 input"""
+        image_path_str = None
+        if isinstance(item, dict):
+            text = item.get("text", "")
+            if item.get("type") == "image":
+                image_path_str = item.get("path")
+        else:
+            text = item
+            # 兼容旧的图片占位符 [图片: xxx] (已废弃，调用方应传入结构化图片输入)
+            m = _IMG_RE.match(text)
+            if m:
+                image_path_str = m.group(1)
+
+        if image_path_str:
+            # 构造完整路径 (图片存储在 settings.IMAGE_DIR)
+            full_image_path = os.path.join(settings.IMAGE_DIR, image_path_str)
+            try:
+                data_uri = await encode_image_async(full_image_path)
+                return [{"type": "image_url", "image_url": {"url": data_uri}}]
+            except FileNotFoundError:
+                logger.warning("Image not found at %s", full_image_path)
+            except Exception as img_err:
+                logger.warning("Image processing failed: %s", img_err)
+            # Fallback to text if image fails
+            return [{"type": "text", "text": text or f"[图片: {image_path_str}]"}]
+
+        return [{"type": "text", "text": text.strip() or " "}]
@@ -2,16 +2,38 @@
 LLM 服务
 """
 
+from collections import OrderedDict
 from openai import AsyncOpenAI
+import asyncio
 import httpx
-from typing import List, Dict, AsyncGenerator, Any
+import logging
+from typing import List, Dict, AsyncGenerator, Any, Optional, Tuple
 from app.core.config import get_settings
+from app.services.embedding import EmbeddingService
+from app.services.semantic_cache import SemanticCache
+from app.utils import HTTP2_AVAILABLE
+from app.utils.async_utils import loop_local
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# AsyncOpenAI 客户端缓存 {事件循环: {(base_url, api_key): client}}，
+# 相同服务地址的 LLMService 实例共享连接池，避免每个请求重新建立 TCP/TLS 连接
+_CLIENTS: Dict[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]] = {}
 
 class LLMService:
     """LLM 服务"""
 
+    # 问题改写缓存 (服务按请求实例化，缓存挂在类上以跨请求共享)
+    _REWRITE_CACHE_MAX = 1024
+    _rewrite_cache: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+    # 语义模式缓存，按 (LLM 地址, LLM 模型, Embedding 地址, Embedding 模型) 分开存放
+    _rewrite_semantic: Dict[Tuple[str, str, str, str], SemanticCache] = {}
+
+    # 流式输出合并：累计达到字符数或距上次输出超过时间间隔 (秒) 时再输出
+    _STREAM_FLUSH_CHARS = 64
+    _STREAM_FLUSH_INTERVAL = 0.02
+
     def __init__(self, base_url: str = None, api_key: str = None, model: str = None):
         self.base_url = base_url or settings.LLM_BASE_URL
         self.api_key = api_key or settings.LLM_API_KEY
@@ -20,18 +42,59 @@ class LLMService:
 
     def _get_client(self):
         if not self._client:
-            self._client = AsyncOpenAI(
-                base_url=self.base_url,
-                api_key=self.api_key,
-                timeout=120.0,
-                http_client=httpx.AsyncClient(
-                    trust_env=False
+            clients = loop_local(_CLIENTS, dict)
+            key = (self.base_url, self.api_key)
+            client = clients.get(key)
+            if client is None:
+                client = clients[key] = AsyncOpenAI(
+                    base_url=self.base_url,
+                    api_key=self.api_key,
+                    timeout=120.0,
+                    http_client=httpx.AsyncClient(
+                        trust_env=False,
+                        http2=HTTP2_AVAILABLE,
+                        limits=httpx.Limits(max_keepalive_connections=32),
+                    )
                 )
-            )
+            self._client = client
         return self._client
 
-    async def rewrite_query(self, query: str) -> str:
-        """问题改写"""
+    @classmethod
+    async def aclose(cls) -> None:
+        """关闭当前事件循环的共享 AsyncOpenAI 客户端 (应用关闭、worker 子进程退出时调用)"""
+        clients = _CLIENTS.pop(asyncio.get_running_loop(), None) or {}
+        for client in clients.values():
+            await client.close()
+
+    async def rewrite_query(self, query: str, embedding_service: Optional[EmbeddingService] = None) -> str:
+        """
+        问题改写
+
+        相同问题直接命中 LRU 缓存；配置了 REWRITE_SEMANTIC_THRESHOLD 且传入 embedding_service 时
+        启用语义模式，与已改写问题的向量相似度达到阈值即复用其改写结果 (默认关闭)。
+        """
+        key = (self.base_url, self.model, query)
+        cached = self._rewrite_cache.get(key)
+        if cached is not None:
+            self._rewrite_cache.move_to_end(key)
+            return cached
+
+        semantic, vector = None, None
+        if embedding_service is not None and settings.REWRITE_SEMANTIC_THRESHOLD > 0:
+            semantic = self._rewrite_semantic.setdefault(
+                (self.base_url, self.model, embedding_service.base_url, embedding_service.model),
+                SemanticCache(threshold=settings.REWRITE_SEMANTIC_THRESHOLD),
+            )
+            try:
+                vector, hit = await embedding_service.semantic_lookup(query, semantic)
+            except Exception as e:
+                # 语义查找失败不影响改写本身
+                logger.warning("Rewrite query embedding failed: %s", e)
+                hit = None
+            if hit is not None:
+                self._remember_rewrite(key, hit)
+                return hit
+
         system_prompt = """你是一个问题优化助手。请将用户输入的口语化问题改写为更清晰、更完整的查询语句。
 要求：
 1. 保持原意不变
@@ -51,11 +114,23 @@ class LLMService:
                 max_tokens=200,
                 temperature=0.3,
             )
-            return response.choices[0].message.content.strip()
+            rewritten = response.choices[0].message.content.strip()
         except Exception as e:
             print(f"Rewrite Query Error: {e}")
             raise e
 
+        self._remember_rewrite(key, rewritten)
+        if semantic is not None and vector:
+            semantic.put(vector, rewritten)
+        return rewritten
+
+    @classmethod
+    def _remember_rewrite(cls, key: Tuple[str, str, str], rewritten: str) -> None:
+        cls._rewrite_cache[key] = rewritten
+        cls._rewrite_cache.move_to_end(key)
+        while len(cls._rewrite_cache) > cls._REWRITE_CACHE_MAX:
+            cls._rewrite_cache.popitem(last=False)
+
     async def generate_stream(
         self,
         messages: List[Dict[str, str]],
@@ -87,9 +162,53 @@ class LLMService:
                 temperature=temperature,
             )
 
-            async for chunk in response:
-                if chunk.choices and chunk.choices[0].delta.content:
-                    yield chunk.choices[0].delta.content
+            # 合并相邻的小块再输出，减少逐 token 的调度与 SSE 写入次数；
+            # 缓冲区非空时等待下一块最多到刷新时限，超时先把已有内容发出去
+            loop = asyncio.get_running_loop()
+            stream = response.__aiter__()
+            buf: List[str] = []
+            buf_len = 0
+            last_flush = loop.time()
+            next_chunk: Optional[asyncio.Future] = None
+            try:
+                while True:
+                    if next_chunk is None:
+                        next_chunk = asyncio.ensure_future(stream.__anext__())
+                    if buf:
+                        remaining = self._STREAM_FLUSH_INTERVAL - (loop.time() - last_flush)
+                        # asyncio.wait 超时不会取消读取，下一轮继续等待同一块
+                        done, _ = await asyncio.wait({next_chunk}, timeout=max(remaining, 0))
+                        if not done:
+                            yield "".join(buf)
+                            buf.clear()
+                            buf_len = 0
+                            last_flush = loop.time()
+                            continue
+
+                    try:
+                        chunk = await next_chunk
+                    except StopAsyncIteration:
+                        break
+                    finally:
+                        next_chunk = None
+
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        delta = chunk.choices[0].delta.content
+                        buf.append(delta)
+                        buf_len += len(delta)
+                        now = loop.time()
+                        if buf_len >= self._STREAM_FLUSH_CHARS or now - last_flush >= self._STREAM_FLUSH_INTERVAL:
+                            yield "".join(buf)
+                            buf.clear()
+                            buf_len = 0
+                            last_flush = now
+            finally:
+                # 调用方提前关闭生成器时，取消尚未完成的读取
+                if next_chunk is not None:
+                    next_chunk.cancel()
+
+            if buf:
+                yield "".join(buf)
 
         except Exception as e:
             print(f"LLM Generate Error: {e}")
@@ -3,19 +3,85 @@
 支持 PDF, Word, Excel, CSV, TXT 格式
 """
 
+import logging
+import mmap
 import os
 import fitz  # PyMuPDF
-from typing import List, Optional, Any
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Iterator, List, Optional, Any, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 import pandas as pd
 from docx import Document as DocxDocument
 from docx.table import Table
 from docx.text.paragraph import Paragraph
+from lxml import etree
 
 from app.core.config import get_settings
+from app.utils.image_utils import image_size_from_header
+
+try:
+    # 可选依赖：流式读取 CSV，未安装时回退到 pandas 分块读取
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+try:
+    # 可选依赖：TXT 既非 UTF-8 也非 GB18030 时探测编码
+    from charset_normalizer import from_bytes as detect_encoding
+except ImportError:
+    detect_encoding = None
 
 settings = get_settings()
+logger = logging.getLogger(__name__)
+
+# parse_many 中大 PDF 按页拆分时每个子任务的页数
+_PDF_PAGES_PER_TASK = 32
+
+# Word run 中图片引用的关系 ID (w:drawing 下 a:blip 的 r:embed)
+_DOCX_BLIP_EMBED_XPATH = etree.XPath(
+    ".//w:drawing//a:blip/@r:embed",
+    namespaces={
+        "w": "http://schemas.openxmlformats.org/wordprocessingml/2006/main",
+        "a": "http://schemas.openxmlformats.org/drawingml/2006/main",
+        "r": "http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+    },
+)
+
+# CSV 流式读取: pyarrow 每块字节数 / pandas 每块行数
+_CSV_BLOCK_SIZE = 1 << 20
+_CSV_ROWS_PER_READ = 10000
+
+# TXT 编码探测读取的前缀字节数
+_TXT_DETECT_BYTES = 64 * 1024
+# 探测结果为这些编码时不予采用 (UTF-8 已解码失败，ASCII 只说明前缀是纯英文)
+_TXT_SKIP_GUESSES = {"ascii", "utf_8"}
+
+
+def _decode_txt(data, file_path: str) -> str:
+    """
+    解码 TXT 内容：依次严格尝试 UTF-8、GB18030 (GBK 的超集)、探测到的编码，
+    均失败时按 GB18030 替换非法字节并记录日志
+    """
+    for encoding in ("utf-8", "gb18030"):
+        try:
+            return str(data, encoding)
+        except UnicodeDecodeError:
+            pass
+
+    if detect_encoding is not None:
+        best = detect_encoding(data[:_TXT_DETECT_BYTES]).best()
+        if best is not None and best.encoding not in _TXT_SKIP_GUESSES:
+            try:
+                return str(data, best.encoding)
+            except (UnicodeDecodeError, LookupError):
+                pass
+
+    logger.warning("TXT 编码无法识别，按 gb18030 替换非法字节解码: %s", file_path)
+    return str(data, "gb18030", "replace")
 
 
 @dataclass
@@ -28,6 +94,81 @@ class ParsedChunk:
     metadata: Optional[dict] = None
 
 
+def _md_cell(value: Any) -> str:
+    """格式化 Markdown 表格单元格 (缺失值留空，浮点数按 g 格式，转义竖线，换行合并为空格)"""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    text = format(value, "g") if isinstance(value, float) else str(value)
+    if "|" in text:
+        text = text.replace("|", "\\|")
+    if "\n" in text or "\r" in text:
+        text = " ".join(text.splitlines())
+    return text
+
+
+def _md_row(values) -> str:
+    return "| " + " | ".join(map(_md_cell, values)) + " |"
+
+
+def _md_header(columns) -> str:
+    """Markdown 表头及分隔行"""
+    columns = list(columns)
+    return _md_row(columns) + "\n" + "|---" * len(columns) + "|"
+
+
+def _md_rows(df: pd.DataFrame) -> List[str]:
+    """
+    将 DataFrame 的每一行渲染为 Markdown 表格行
+
+    整表只渲染一次，切片时直接拼接行文本；不做列宽对齐
+    (DataFrame.to_markdown 经 tabulate 逐单元格推断类型、计算列宽，大表逐片调用时开销很大)
+    """
+    return [_md_row(row) for row in df.itertuples(index=False, name=None)]
+
+
+def _read_csv_rows(file_path: str) -> Tuple[List[str], Iterator[tuple]]:
+    """
+    流式读取 CSV，返回 (列名, 行迭代器)，内存占用与文件大小无关
+
+    所有列都按字符串读取：保留单元格原文，也避免分块类型推断前后不一致
+    """
+    if pa is None:
+        columns = list(pd.read_csv(file_path, nrows=0).columns)
+
+        def pandas_rows():
+            for df in pd.read_csv(file_path, dtype=str, chunksize=_CSV_ROWS_PER_READ):
+                yield from df.itertuples(index=False, name=None)
+
+        return columns, pandas_rows()
+
+    read_options = pa_csv.ReadOptions(block_size=_CSV_BLOCK_SIZE)
+    # 与 pandas 一致：允许引号内的字段包含换行
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    # 先打开一次取列名 (只读取首块)，再按全字符串列类型重新打开
+    probe = pa_csv.open_csv(file_path, read_options=read_options, parse_options=parse_options)
+    columns = probe.schema.names
+    probe.close()
+    convert_options = pa_csv.ConvertOptions(
+        column_types={name: pa.string() for name in columns},
+        strings_can_be_null=True,
+    )
+
+    def arrow_rows():
+        reader = pa_csv.open_csv(
+            file_path,
+            read_options=read_options,
+            parse_options=parse_options,
+            convert_options=convert_options,
+        )
+        try:
+            for batch in reader:
+                yield from zip(*(column.to_pylist() for column in batch.columns))
+        finally:
+            reader.close()
+
+    return columns, arrow_rows()
+
+
 class TextSplitter:
     """文本切分器"""
 
@@ -40,6 +181,8 @@ class TextSplitter:
         self.chunk_size = chunk_size or settings.CHUNK_SIZE
         self.chunk_overlap = chunk_overlap or settings.CHUNK_OVERLAP
         self.separator = separator.replace("\\n", "\n") if separator else "\n\n"
+        # 优先使用配置的分隔符，其次是通用分隔符
+        self.separators = (self.separator, "\n", "。", ".", " ")
 
     def split(self, text: str) -> List[str]:
         """切分文本"""
@@ -52,6 +195,11 @@ class TextSplitter:
         chunks = []
         start = 0
 
+        # 按优先级查找分隔符
+        # (str.rfind 在有界窗口内由 C 实现扫描，比预先收集全文分隔符位置再二分更快)
+        separators = self.separators
+        half_size = self.chunk_size // 2
+
         while start < len(text):
             # 如果剩余长度小于块大小，直接作为一个块
             if len(text) - start <= self.chunk_size:
@@ -64,13 +212,10 @@ class TextSplitter:
             best_end = end
             
             # 查找最近的分隔符（向前查找）
-            # 优先使用配置的分隔符，其次是通用分隔符
-            separators = [self.separator, "\n", "。", ".", " "]
-            
             found_sep = False
+            # 在 [start + chunk_size/2, end] 范围内查找
+            min_search_pos = start + half_size
             for sep in separators:
-                # 在 [start + chunk_size/2, end] 范围内查找
-                min_search_pos = max(start + self.chunk_size // 2, start)
                 sep_pos = text.rfind(sep, min_search_pos, end)
                 if sep_pos > start:
                     best_end = sep_pos + len(sep)
@@ -85,16 +230,21 @@ class TextSplitter:
             if chunk:
                 chunks.append(chunk)
             
-            # 下一块的起始位置，考虑重叠
-            start = best_end - self.chunk_overlap
-            
-            # 防止死循环
-            if start <= start: # 如果重叠导致没前进
-                 start = best_end
+            # 下一块的起始位置，考虑重叠；
+            # 每次至少前进本块长度的一半 (且不越过 best_end，不遗漏文本)，
+            # 重叠过大时也能保证线性推进，不会反复扫描同一段文本
+            min_next = start + max(1, (best_end - start) // 2)
+            start = max(best_end - self.chunk_overlap, min_next)
 
         return chunks
 
 
+@lru_cache(maxsize=32)
+def get_splitter(chunk_size: int = None, chunk_overlap: int = None, separator: str = "\n\n") -> TextSplitter:
+    """获取切分器 (相同参数复用同一实例，TextSplitter 创建后不再修改，可安全共享)"""
+    return TextSplitter(chunk_size, chunk_overlap, separator)
+
+
 class FileParser:
     """文件解析器"""
 
@@ -109,7 +259,8 @@ class FileParser:
         chunk_mode: str = "auto", # auto, no_chunk, custom
         chunk_size: int = 500,
         chunk_overlap: int = 50,
-        separator: str = "\n\n"
+        separator: str = "\n\n",
+        page_range: Optional[Tuple[int, int]] = None,
     ) -> List[ParsedChunk]:
         """
         解析文件
@@ -120,14 +271,15 @@ class FileParser:
             chunk_size: 块大小
             chunk_overlap: 重叠大小
             separator: 分隔符
+            page_range: 只解析 [起始页, 结束页) 的页面 (从 0 开始，仅 PDF 有效)
         """
-        self.splitter = TextSplitter(chunk_size, chunk_overlap, separator)
+        self.splitter = get_splitter(chunk_size, chunk_overlap, separator)
         self.chunk_mode = chunk_mode
         
         ext = os.path.splitext(file_path)[1].lower()
 
         if ext == ".pdf":
-            return self._parse_pdf(file_path)
+            return self._parse_pdf(file_path, page_range)
         elif ext == ".docx":
             return self._parse_docx(file_path)
         elif ext == ".xlsx":
@@ -141,6 +293,44 @@ class FileParser:
         else:
             raise ValueError(f"不支持的文件格式: {ext}")
 
+    def parse_many(self, file_paths: List[str], max_workers: int = None, **kwargs) -> List[List[ParsedChunk]]:
+        """
+        多进程并行解析多个文件，超过 _PDF_PAGES_PER_TASK 页的 PDF 再按页拆分
+
+        注意：不能在 Celery prefork worker 中调用 (守护进程不能再创建子进程)，
+        单文件任务已由 Celery 的多个 worker 并行处理。
+
+        Args:
+            file_paths: 文件路径列表
+            max_workers: 进程数，默认 CPU 核数
+            **kwargs: 传给 parse 的切分参数
+
+        Returns:
+            与 file_paths 顺序一致的解析结果，每个文件内按页顺序排列
+        """
+        tasks = []
+        owners = []
+        for idx, file_path in enumerate(file_paths):
+            page_ranges = [None]
+            if os.path.splitext(file_path)[1].lower() == ".pdf":
+                with fitz.open(file_path) as doc:
+                    page_count = doc.page_count
+                if page_count > _PDF_PAGES_PER_TASK:
+                    page_ranges = [
+                        (start, min(start + _PDF_PAGES_PER_TASK, page_count))
+                        for start in range(0, page_count, _PDF_PAGES_PER_TASK)
+                    ]
+            for page_range in page_ranges:
+                tasks.append((self.kb_id, file_path, page_range, kwargs))
+                owners.append(idx)
+
+        results: List[List[ParsedChunk]] = [[] for _ in file_paths]
+        with ProcessPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+            # map 按提交顺序返回，同一文件的页范围结果依次合并
+            for idx, chunks in zip(owners, pool.map(_parse_in_worker, tasks)):
+                results[idx].extend(chunks)
+        return results
+
     def _save_image(self, image_bytes: bytes, file_id: str, page_num: int, img_index: int, ext: str = "png") -> str:
         """保存图片到本地"""
         image_filename = f"{file_id}_p{page_num}_i{img_index}.{ext}"
@@ -156,20 +346,19 @@ class FileParser:
 
     def _process_text_content(self, text: str, page_num: int) -> List[ParsedChunk]:
         """处理文本内容（根据切分策略）"""
-        if not text.strip():
+        cleaned_text = text.strip()
+        if not cleaned_text:
             return []
             
         chunks = []
         # 处理不切分模式
         if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
             # 即使不切分，也可能需要处理一些基本的清理
-            cleaned_text = text.strip()
-            if cleaned_text:
-                chunks.append(ParsedChunk(
-                    content=cleaned_text,
-                    page_number=page_num,
-                    content_type="text"
-                ))
+            chunks.append(ParsedChunk(
+                content=cleaned_text,
+                page_number=page_num,
+                content_type="text"
+            ))
         else:
             text_chunks = self.splitter.split(text)
             for tc in text_chunks:
@@ -180,38 +369,50 @@ class FileParser:
                 ))
         return chunks
 
-    def _parse_pdf(self, file_path: str) -> List[ParsedChunk]:
+    def _parse_pdf(self, file_path: str, page_range: Optional[Tuple[int, int]] = None) -> List[ParsedChunk]:
         """解析 PDF 文件 (包含图片提取和顺序保持)"""
         chunks = []
         doc = fitz.open(file_path)
         file_id = os.path.basename(file_path).split("_")[0]
+        first_page, last_page = page_range or (0, doc.page_count)
 
-        for page_num, page in enumerate(doc, start=1):
+        for page_num, page in enumerate(doc.pages(first_page, last_page), start=first_page + 1):
             # 获取页面上的所有块 (text, image)
             # sort=True 会根据垂直坐标排序，符合阅读顺序
-            blocks = page.get_text("dict", sort=True)["blocks"]
+            # get_image_info 同时包含 XObject 图片与内联图片 (get_images 不含内联图片)
+            if page.get_image_info():
+                blocks = page.get_text("dict", sort=True)["blocks"]
+            else:
+                # 本页没有图片：纯文本快速路径，直接使用 MuPDF 拼好的块文本，
+                # 不构造逐行、逐 span 的字典
+                blocks = [
+                    {"type": 0, "text": b[4]}
+                    for b in page.get_text("blocks", sort=True)
+                    if b[6] == 0
+                ]
             
             # 如果是不切分模式，我们在页面级别聚合所有文本
             # 否则我们依然在 block 级别处理，以便正确插入图片
-            page_text_buffer = ""
+            page_text_parts: List[str] = []
             
             # 临时存储本页的chunks，最后再根据模式决定如何合并
             page_chunks = []
-            current_text_buffer = ""
+            current_text_parts: List[str] = []
 
             for block_idx, block in enumerate(blocks):
                 if block["type"] == 0:  # Text Block
-                    # 提取文本
-                    block_text = ""
-                    for line in block["lines"]:
-                        for span in line["spans"]:
-                            block_text += span["text"]
-                        block_text += "\n"
+                    # 提取文本 (逐行拼接 span，每行以换行结尾)
+                    block_text = block.get("text")
+                    if block_text is None:
+                        block_text = "".join(
+                            "".join(span["text"] for span in line["spans"]) + "\n"
+                            for line in block["lines"]
+                        )
                     
                     if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
-                        page_text_buffer += block_text
+                        page_text_parts.append(block_text)
                     else:
-                        current_text_buffer += block_text
+                        current_text_parts.append(block_text)
                     
                 elif block["type"] == 1:  # Image Block
                     # 2. 处理图片
@@ -221,14 +422,10 @@ class FileParser:
                         img_size = len(image_bytes)
                         
                         # 获取图片尺寸信息 (用于调试和过滤)
-                        width, height = 0, 0
-                        try:
-                            # 尝试从 bytes 创建 pixmap 获取尺寸
-                            pix = fitz.Pixmap(image_bytes)
-                            width, height = pix.width, pix.height
-                            pix = None # 释放资源
-                        except Exception:
-                            pass
+                        # 图片块自带宽高，缺失时只读取图片头部，不解码整张图片
+                        width, height = block.get("width", 0), block.get("height", 0)
+                        if not (width and height):
+                            width, height = image_size_from_header(image_bytes)
 
                         # 打印调试信息
                         print(f"🔍 [PDF Image Debug] Page: {page_num} | Size: {img_size} bytes ({img_size/1024:.2f} KB) | Dim: {width}x{height} | Ext: {image_ext}")
@@ -249,9 +446,9 @@ class FileParser:
 
                         # 只有图片有效时，才结算之前的文本 (仅在非 no_split 模式下)
                         if self.chunk_mode != "no_split" and self.chunk_mode != "no_chunk":
-                            if current_text_buffer:
-                                page_chunks.extend(self._process_text_content(current_text_buffer, page_num))
-                                current_text_buffer = ""
+                            if current_text_parts:
+                                page_chunks.extend(self._process_text_content("".join(current_text_parts), page_num))
+                                current_text_parts.clear()
 
                         # 保存图片
                         saved_path = self._save_image(image_bytes, file_id, page_num, block_idx, image_ext)
@@ -276,18 +473,18 @@ class FileParser:
             # 页面结束处理
             if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
                 # 不切分模式：处理整个页面的文本
-                if page_text_buffer:
+                if page_text_parts:
                     # 将文本块插入到 chunks 开头（或者根据业务逻辑）
                     # 这里简单的处理：文本作为一个大块，图片作为独立块
                     # 如果希望图片穿插在文本中，那 no_split 的定义就比较模糊了
                     # 既然是 "按页不切分"，那么这一页的所有文本应该是一个块
-                    chunks.extend(self._process_text_content(page_text_buffer, page_num))
+                    chunks.extend(self._process_text_content("".join(page_text_parts), page_num))
                 # 追加本页提取的所有图片
                 chunks.extend(page_chunks)
             else:
                 # 普通切分模式：处理剩余的 buffer
-                if current_text_buffer:
-                    page_chunks.extend(self._process_text_content(current_text_buffer, page_num))
+                if current_text_parts:
+                    page_chunks.extend(self._process_text_content("".join(current_text_parts), page_num))
                 chunks.extend(page_chunks)
 
         doc.close()
@@ -298,88 +495,74 @@ class FileParser:
         chunks = []
         doc = DocxDocument(file_path)
         file_id = os.path.basename(file_path).split("_")[0]
+        related_parts = doc.part.related_parts
         
-        current_text_buffer = ""
+        current_text_parts: List[str] = []
         # 用于 no_split 模式的页面级缓存
-        page_text_buffer = ""
+        page_text_parts: List[str] = []
         page_image_chunks = []
         
         # 辅助函数：处理段落中的图片和文本
         def process_paragraph(para, page_num):
-            nonlocal current_text_buffer, page_text_buffer, page_image_chunks
-            
-            # 临时文本，用于当前段落
-            para_text = ""
-            
             for run in para.runs:
-                # 1. 提取文本
-                if run.text:
+                # 1. 提取文本 (run.text 每次访问都会遍历 XML，只取一次)
+                run_text = run.text
+                if run_text:
                     if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
-                        page_text_buffer += run.text
+                        page_text_parts.append(run_text)
                     else:
-                        current_text_buffer += run.text
-                    para_text += run.text
+                        current_text_parts.append(run_text)
                 
                 # 2. 检查图片
-                # 查找 run 元素下的 drawing 标签
-                if 'drawing' in run.element.xml:
-                    drawings = run.element.findall('.//{http://schemas.openxmlformats.org/wordprocessingml/2006/main}drawing')
-                    for drawing in drawings:
-                        # 找到 blip 元素获取 rId
-                        nsmap = {
-                            'a': 'http://schemas.openxmlformats.org/drawingml/2006/main',
-                            'r': 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
-                        }
-                        blips = drawing.findall('.//a:blip', namespaces=nsmap)
-                        for blip in blips:
-                            rId = blip.get('{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed')
-                            if rId:
-                                try:
-                                    image_part = doc.part.related_parts[rId]
-                                    image_bytes = image_part.blob
+                # 预编译 XPath 直接取出 drawing 下 blip 的 rId，无需把 run 序列化为 XML 字符串
+                for rId in _DOCX_BLIP_EMBED_XPATH(run.element):
+                    if rId:
+                        try:
+                            image_part = related_parts[rId]
+                            image_bytes = image_part.blob
                                     
-                                    # 过滤过小的图片 (小于 2KB)
-                                    if len(image_bytes) < 2048:
-                                        print(f"🔍 [Parser] 跳过过小图片 (Word): {len(image_bytes)} bytes")
-                                        continue
-
-                                    content_type = image_part.content_type
-                                    ext = content_type.split('/')[-1] if '/' in content_type else "png"
-                                    if ext == "jpeg": ext = "jpg"
+                            # 过滤过小的图片 (小于 2KB)
+                            if len(image_bytes) < 2048:
+                                print(f"🔍 [Parser] 跳过过小图片 (Word): {len(image_bytes)} bytes")
+                                continue
+
+                            content_type = image_part.content_type
+                            ext = content_type.split('/')[-1] if '/' in content_type else "png"
+                            if ext == "jpeg": ext = "jpg"
                                     
-                                    # 保存图片
-                                    img_idx = len(chunks) + len(page_image_chunks)
-                                    saved_path = self._save_image(image_bytes, file_id, page_num, img_idx, ext)
+                            # 保存图片
+                            img_idx = len(chunks) + len(page_image_chunks)
+                            saved_path = self._save_image(image_bytes, file_id, page_num, img_idx, ext)
                                     
-                                    image_chunk = ParsedChunk(
-                                        content=f"[图片: {saved_path}]",
-                                        page_number=page_num,
-                                        content_type="image",
-                                        image_path=saved_path,
-                                        metadata={
-                                            "timestamp": datetime.now().isoformat(),
-                                            "original_name": f"image_docx_{img_idx}"
-                                        }
-                                    )
+                            image_chunk = ParsedChunk(
+                                content=f"[图片: {saved_path}]",
+                                page_number=page_num,
+                                content_type="image",
+                                image_path=saved_path,
+                                metadata={
+                                    "timestamp": datetime.now().isoformat(),
+                                    "original_name": f"image_docx_{img_idx}"
+                                }
+                            )
                                     
-                                    if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
-                                        # 在 no_split 模式下，图片单独收集，不打断文本流
-                                        page_image_chunks.append(image_chunk)
-                                    else:
-                                        # 普通模式：结算前面的文本
-                                        if current_text_buffer:
-                                            chunks.extend(self._process_text_content(current_text_buffer, page_num))
-                                            current_text_buffer = ""
-                                        chunks.append(image_chunk)
+                            if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
+                                # 在 no_split 模式下，图片单独收集，不打断文本流
+                                page_image_chunks.append(image_chunk)
+                            else:
+                                # 普通模式：结算前面的文本
+                                if current_text_parts:
+                                    chunks.extend(self._process_text_content("".join(current_text_parts), page_num))
+                                    current_text_parts.clear()
+                                chunks.append(image_chunk)
                                         
-                                except Exception as e:
-                                    print(f"Word 图片提取失败: {e}")
+                        except Exception as e:
+                            print(f"Word 图片提取失败: {e}")
             
             # 段落结束换行
             if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
-                page_text_buffer += "\n"
+                page_text_parts.append("\n")
             else:
-                current_text_buffer += "\n"
+                current_text_parts.append("\n")
 
         # 遍历文档元素
         page_num_estimate = 1
@@ -389,9 +572,9 @@ class FileParser:
             # 检查是否需要分页结算 (仅针对 no_split 模式)
             if (self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk") and para_count > 10:
                 # 结算上一页的文本和图片
-                if page_text_buffer:
-                    chunks.extend(self._process_text_content(page_text_buffer, page_num_estimate))
-                    page_text_buffer = ""
+                if page_text_parts:
+                    chunks.extend(self._process_text_content("".join(page_text_parts), page_num_estimate))
+                    page_text_parts.clear()
                 if page_image_chunks:
                     chunks.extend(page_image_chunks)
                     page_image_chunks = []
@@ -417,17 +600,17 @@ class FileParser:
                     rows_data.append(row_cells)
                 
                 if rows_data:
-                    df = pd.DataFrame(rows_data)
-                    md_table = df.to_markdown(index=False, header=False)
+                    # 首行作为表头
+                    md_table = "\n".join([_md_header(rows_data[0])] + [_md_row(r) for r in rows_data[1:]])
                     
                     if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
                         # no_split 模式：表格作为 Markdown 拼接到文本中
-                        page_text_buffer += f"\n{md_table}\n"
+                        page_text_parts.append(f"\n{md_table}\n")
                     else:
                         # 普通模式：结算文本，表格单独成块
-                        if current_text_buffer:
-                            chunks.extend(self._process_text_content(current_text_buffer, page_num_estimate))
-                            current_text_buffer = ""
+                        if current_text_parts:
+                            chunks.extend(self._process_text_content("".join(current_text_parts), page_num_estimate))
+                            current_text_parts.clear()
                         
                         chunks.append(ParsedChunk(
                             content=md_table,
@@ -437,24 +620,24 @@ class FileParser:
 
         # 处理剩余文本
         if self.chunk_mode == "no_split" or self.chunk_mode == "no_chunk":
-            if page_text_buffer:
-                chunks.extend(self._process_text_content(page_text_buffer, page_num_estimate))
+            if page_text_parts:
+                chunks.extend(self._process_text_content("".join(page_text_parts), page_num_estimate))
             if page_image_chunks:
                 chunks.extend(page_image_chunks)
         else:
-            if current_text_buffer:
-                chunks.extend(self._process_text_content(current_text_buffer, page_num_estimate))
+            if current_text_parts:
+                chunks.extend(self._process_text_content("".join(current_text_parts), page_num_estimate))
             
         return chunks
 
     def _parse_txt(self, file_path: str) -> List[ParsedChunk]:
         """解析 TXT 文件"""
-        try:
-            with open(file_path, mode='r', encoding='utf-8') as f:
-                content = f.read()
-        except UnicodeDecodeError:
-            with open(file_path, mode='r', encoding='gbk') as f:
-                content = f.read()
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            # 内存映射后直接解码，文件只读取一次
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                content = _decode_txt(data, file_path)
         
         return self._process_text_content(content, 1)
 
@@ -515,9 +698,10 @@ class FileParser:
             df = pd.read_excel(xlsx, sheet_name=sheet_name)
             # Excel 通常按行切分，不使用通用 TextSplitter
             chunk_size = 20
-            for i in range(0, len(df), chunk_size):
-                chunk_df = df.iloc[i:i + chunk_size]
-                md_table = chunk_df.to_markdown(index=False)
+            header = _md_header(df.columns)
+            rows = _md_rows(df)
+            for i in range(0, len(rows), chunk_size):
+                md_table = header + "\n" + "\n".join(rows[i:i + chunk_size])
 
                 chunks.append(ParsedChunk(
                     content=f"[工作表: {sheet_name}]\n{md_table}",
@@ -529,15 +713,26 @@ class FileParser:
     def _parse_csv(self, file_path: str) -> List[ParsedChunk]:
         """解析 CSV 文件"""
         chunks = []
-        df = pd.read_csv(file_path)
+        columns, rows = _read_csv_rows(file_path)
         chunk_size = 20
-        for i in range(0, len(df), chunk_size):
-            chunk_df = df.iloc[i:i + chunk_size]
-            md_table = chunk_df.to_markdown(index=False)
+        header = _md_header(columns)
+        page_number = 0
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                break
+            page_number += 1
+            md_table = header + "\n" + "\n".join(map(_md_row, batch))
 
             chunks.append(ParsedChunk(
                 content=md_table,
-                page_number=i // chunk_size + 1,
+                page_number=page_number,
                 content_type="table",
             ))
         return chunks
+
+
+def _parse_in_worker(task: Tuple[str, str, Optional[Tuple[int, int]], dict]) -> List[ParsedChunk]:
+    """parse_many 的子进程入口 (需为模块级函数以便 pickle)"""
+    kb_id, file_path, page_range, kwargs = task
+    return FileParser(kb_id).parse(file_path, page_range=page_range, **kwargs)
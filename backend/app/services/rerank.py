@@ -2,23 +2,83 @@
 Rerank 服务模块
 """
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
+import asyncio
 import httpx
 import json
-import re
-from typing import List, Dict, Any, Optional
+import threading
+from typing import List, Dict, Any, Optional, Tuple
 from app.models.models import CustomModel, ModelType
 from app.core.database import get_session
 from sqlmodel import select, Session
 from app.core.rerank_model import RerankModelLoader
+from app.utils import HTTP2_AVAILABLE
+from app.utils.async_utils import loop_local
+
+try:
+    # google-re2 (可选依赖) 保证线性时间匹配，模型输出格式异常时不会出现回溯退化
+    import re2 as _re
+except ImportError:
+    import re as _re
+
+# 使用内联 (?s) 标志，re 与 re2 的写法一致
+_THINK_RE = _re.compile(r"(?s)<think>.*?</think>")
+_CODE_BLOCK_RE = _re.compile(r"(?s)```(?:json)?\s*(.*?)```")
+
+# OpenAI 客户端按 (base_url, api_key) 复用，保持连接池 (同步客户端可跨线程共享)
+_CLIENT_CACHE: Dict[Tuple[str, str], OpenAI] = {}
+_client_lock = threading.Lock()
+
+
+def _get_client(base_url: str, api_key: str) -> OpenAI:
+    key = (base_url, api_key)
+    client = _CLIENT_CACHE.get(key)
+    if client is None:
+        with _client_lock:
+            client = _CLIENT_CACHE.get(key)
+            if client is None:
+                client = _CLIENT_CACHE[key] = OpenAI(
+                    base_url=base_url,
+                    api_key=api_key,
+                    http_client=httpx.Client(
+                        trust_env=False,
+                        http2=HTTP2_AVAILABLE,
+                        limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+                    )
+                )
+    return client
+
+
+# 异步客户端与并发信号量绑定事件循环，按事件循环分别缓存
+_RERANK_MAX_CONCURRENCY = 8
+_ASYNC_CLIENTS: Dict[asyncio.AbstractEventLoop, Dict[Tuple[str, str], AsyncOpenAI]] = {}
+_SEMAPHORES: Dict[asyncio.AbstractEventLoop, asyncio.Semaphore] = {}
+
+
+def _get_async_client(base_url: str, api_key: str) -> AsyncOpenAI:
+    clients = loop_local(_ASYNC_CLIENTS, dict)
+    key = (base_url, api_key)
+    client = clients.get(key)
+    if client is None:
+        client = clients[key] = AsyncOpenAI(
+            base_url=base_url,
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                trust_env=False,
+                http2=HTTP2_AVAILABLE,
+                limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+            )
+        )
+    return client
 
 def extract_json_from_text(text: str) -> str:
     """从模型响应中提取 JSON 字符串"""
     # 1. 移除 <think> 思考过程
-    text = re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL)
+    if "<think>" in text:
+        text = _THINK_RE.sub('', text)
     
     # 2. 尝试提取 markdown 代码块
-    match = re.search(r'```(?:json)?\s*(.*?)```', text, re.DOTALL)
+    match = _CODE_BLOCK_RE.search(text) if "```" in text else None
     if match:
         return match.group(1).strip()
         
@@ -34,6 +94,23 @@ class RerankService:
     def __init__(self, session: Session):
         self.session = session
 
+    @classmethod
+    async def aclose(cls) -> None:
+        """关闭当前事件循环的共享异步客户端 (应用关闭、worker 子进程退出时调用)"""
+        loop = asyncio.get_running_loop()
+        _SEMAPHORES.pop(loop, None)
+        for client in (_ASYNC_CLIENTS.pop(loop, None) or {}).values():
+            await client.close()
+
+    @classmethod
+    def close(cls) -> None:
+        """关闭进程内共享的同步客户端 (不依赖事件循环)"""
+        with _client_lock:
+            clients = list(_CLIENT_CACHE.values())
+            _CLIENT_CACHE.clear()
+        for client in clients:
+            client.close()
+
     def get_rerank_model_by_id(self, model_id: str) -> Optional[CustomModel]:
         """根据 ID 获取 Rerank 模型"""
         return self.session.get(CustomModel, model_id)
@@ -89,16 +166,44 @@ class RerankService:
             traceback.print_exc()
             return []
 
-    def _rerank_via_api(self, query: str, candidates: List[str], model: CustomModel) -> List[Dict[str, Any]]:
-        """通过 API 调用 Rerank"""
-        client = OpenAI(
-            base_url=model.base_url,
-            api_key=model.api_key,
-            http_client=httpx.Client(
-                trust_env=False
+    async def rerank_many(
+        self,
+        queries: List[str],
+        candidates_list: List[List[str]],
+        model: Optional[CustomModel] = None,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        对多组 (查询, 候选文本) 执行重排序
+
+        远程 API 模型并发调用 (最多 _RERANK_MAX_CONCURRENCY 个请求同时进行)；
+        本地模型在线程中依次推理，不阻塞事件循环。
+        :return: 与 queries 顺序一致的排序结果，单组失败时该组为空列表
+        """
+        if not model:
+            model = self.get_default_rerank_model()
+
+        if not model:
+            print("No active rerank model found.")
+            return [[] for _ in queries]
+
+        is_remote_api = model.base_url.startswith("http://") or model.base_url.startswith("https://")
+        if not is_remote_api:
+            return await asyncio.to_thread(
+                lambda: [self.rerank(q, c, model=model) for q, c in zip(queries, candidates_list)]
             )
-        )
 
+        semaphore = loop_local(_SEMAPHORES, lambda: asyncio.Semaphore(_RERANK_MAX_CONCURRENCY))
+
+        async def run(query: str, candidates: List[str]) -> List[Dict[str, Any]]:
+            if not candidates:
+                return []
+            async with semaphore:
+                return await self._arerank_via_api(query, candidates, model)
+
+        return list(await asyncio.gather(*(run(q, c) for q, c in zip(queries, candidates_list))))
+
+    @staticmethod
+    def _build_prompt(query: str, candidates: List[str]) -> str:
         prompt = f"""你是一个文本相关性重排序模型，请计算查询与每个候选文本的相关性得分（0-1，越接近1越相关）。
 
 查询："{query}"
@@ -121,34 +226,57 @@ class RerankService:
 
 /no_think
 """
+        return prompt
+
+    @staticmethod
+    def _parse_response(result_text: str) -> List[Dict[str, Any]]:
+        json_str = extract_json_from_text(result_text)
+        data = json.loads(json_str)
+
+        if "candidates" in data:
+            results = data["candidates"]
+        elif isinstance(data, list):
+            results = data
+        else:
+            return []
+
+        final_results = []
+        for item in results:
+            if "index" in item and "score" in item:
+                final_results.append({
+                    "index": item["index"],
+                    "score": float(item["score"]),
+                    "text": item.get("text", "")
+                })
+        final_results.sort(key=lambda x: x["score"], reverse=True)
+        return final_results
+
+    def _rerank_via_api(self, query: str, candidates: List[str], model: CustomModel) -> List[Dict[str, Any]]:
+        """通过 API 调用 Rerank"""
+        client = _get_client(model.base_url, model.api_key)
         try:
             response = client.chat.completions.create(
                 model=model.model_name,
-                messages=[{"role": "user", "content": prompt}],
+                messages=[{"role": "user", "content": self._build_prompt(query, candidates)}],
                 temperature=0.0,
                 stream=False,
             )
-            result_text = response.choices[0].message.content
-            json_str = extract_json_from_text(result_text)
-            data = json.loads(json_str)
-            
-            if "candidates" in data:
-                results = data["candidates"]
-            elif isinstance(data, list):
-                results = data
-            else:
-                return []
-            
-            final_results = []
-            for item in results:
-                if "index" in item and "score" in item:
-                    final_results.append({
-                        "index": item["index"],
-                        "score": float(item["score"]),
-                        "text": item.get("text", "")
-                    })
-            final_results.sort(key=lambda x: x["score"], reverse=True)
-            return final_results
+            return self._parse_response(response.choices[0].message.content)
+        except Exception as e:
+            print(f"API Rerank failed: {e}")
+            return []
+
+    async def _arerank_via_api(self, query: str, candidates: List[str], model: CustomModel) -> List[Dict[str, Any]]:
+        """通过 API 调用 Rerank (异步)"""
+        client = _get_async_client(model.base_url, model.api_key)
+        try:
+            response = await client.chat.completions.create(
+                model=model.model_name,
+                messages=[{"role": "user", "content": self._build_prompt(query, candidates)}],
+                temperature=0.0,
+                stream=False,
+            )
+            return self._parse_response(response.choices[0].message.content)
         except Exception as e:
             print(f"API Rerank failed: {e}")
             return []
@@ -195,7 +323,7 @@ def test_rerank_connection(model_in: Any) -> Dict[str, Any]:
             if isinstance(model_in, dict):
                 api_key = model_in.get("api_key", "")
                 
-            client = OpenAI(base_url=base_url, api_key=api_key)
+            client = _get_client(base_url, api_key)
             # ... 发送简单请求 ...
             # 鉴于用户主要关注本地，这里简单做个连通性检查即可，或者复用上面的 prompt
             # 为了完整性，还是写全一点
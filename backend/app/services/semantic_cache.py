@@ -0,0 +1,88 @@
+"""
+语义缓存服务
+"""
+
+import time
+import threading
+import numpy as np
+from typing import Any, Dict, List, Optional
+
+
+class _Partition:
+    """同一维度向量的存储分区"""
+
+    def __init__(self, dim: int):
+        self.vectors = np.empty((0, dim), dtype=np.float32)  # 已归一化
+        self.expires = np.empty((0,), dtype=np.float64)
+        self.values: List[Any] = []
+
+
+class SemanticCache:
+    """
+    语义缓存
+
+    以向量为键，查找时返回余弦相似度不低于阈值的最相近条目。
+    向量按维度分区存放在矩阵中，每个条目带过期时间。
+    """
+
+    def __init__(self, threshold: float = 0.86, ttl: float = 3600.0, max_entries: int = 4096):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._partitions: Dict[int, _Partition] = {}
+        self._lock = threading.Lock()
+
+    def get(self, vector: List[float]) -> Optional[Any]:
+        """查找与 vector 足够相似的缓存值，未命中返回 None"""
+        q = self._normalize(vector)
+        if q is None:
+            return None
+
+        with self._lock:
+            part = self._partitions.get(q.shape[0])
+            if part is None or not part.values:
+                return None
+
+            sims = part.vectors @ q
+            sims[part.expires < time.time()] = -np.inf
+            best = int(np.argmax(sims))
+            if sims[best] >= self.threshold:
+                return part.values[best]
+        return None
+
+    def put(self, vector: List[float], value: Any) -> None:
+        """写入缓存条目"""
+        q = self._normalize(vector)
+        if q is None:
+            return
+
+        with self._lock:
+            part = self._partitions.setdefault(q.shape[0], _Partition(q.shape[0]))
+            now = time.time()
+
+            # 清理过期条目，超出容量时淘汰最早写入的条目
+            keep = part.expires >= now
+            overflow = int(keep.sum()) + 1 - self.max_entries
+            if overflow > 0:
+                keep[np.flatnonzero(keep)[:overflow]] = False
+            if not keep.all():
+                part.vectors = part.vectors[keep]
+                part.expires = part.expires[keep]
+                part.values = [v for v, k in zip(part.values, keep) if k]
+
+            part.vectors = np.vstack([part.vectors, q[None, :]])
+            part.expires = np.append(part.expires, now + self.ttl)
+            part.values.append(value)
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._partitions.clear()
+
+    @staticmethod
+    def _normalize(vector: List[float]) -> Optional[np.ndarray]:
+        v = np.asarray(vector, dtype=np.float32).ravel()
+        norm = float(np.linalg.norm(v))
+        if v.size == 0 or norm == 0:
+            return None
+        return v / norm
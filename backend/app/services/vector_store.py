@@ -2,19 +2,27 @@
 向量存储服务 (ChromaDB)
 """
 
+import threading
 import chromadb
+import numpy as np
 from chromadb.config import Settings as ChromaSettings
-from typing import List, Dict, Any, Optional
+from typing import Callable, List, Dict, Any, Optional, TypeVar, Union
 
 from app.core.config import get_settings
 
 settings = get_settings()
 
+T = TypeVar("T")
+
 
 class VectorStoreService:
     """向量存储服务"""
 
     _client = None
+    # Collection 句柄缓存 (kb_id -> Collection)，服务按请求实例化，缓存挂在类上
+    _collections: Dict[str, Any] = {}
+    _collections_lock = threading.Lock()
+    _max_batch: Optional[int] = None
 
     @classmethod
     def get_client(cls) -> chromadb.Client:
@@ -35,14 +43,17 @@ class VectorStoreService:
     def create_collection(self, kb_id: str) -> None:
         """创建知识库对应的 Collection"""
         collection_name = self._get_collection_name(kb_id)
-        self.client.get_or_create_collection(
+        collection = self.client.get_or_create_collection(
             name=collection_name,
             metadata={"kb_id": kb_id},
         )
+        with self._collections_lock:
+            self._collections[kb_id] = collection
 
     def delete_collection(self, kb_id: str) -> None:
         """删除知识库对应的 Collection"""
         collection_name = self._get_collection_name(kb_id)
+        self._evict_collection(kb_id)
         try:
             self.client.delete_collection(name=collection_name)
         except Exception:
@@ -52,7 +63,7 @@ class VectorStoreService:
         self,
         kb_id: str,
         documents: List[Dict[str, Any]],
-        embeddings: List[List[float]],
+        embeddings: Union[List[List[float]], np.ndarray],
     ) -> None:
         """
         添加文档到向量库
@@ -60,21 +71,28 @@ class VectorStoreService:
         Args:
             kb_id: 知识库 ID
             documents: 文档列表，每个文档包含 id, content, metadata
-            embeddings: 对应的向量列表
+            embeddings: 对应的向量列表或 (n, dim) 矩阵
         """
-        collection_name = self._get_collection_name(kb_id)
-        collection = self.client.get_or_create_collection(name=collection_name)
-
         ids = [doc["id"] for doc in documents]
         contents = [doc["content"] for doc in documents]
         metadatas = [doc.get("metadata", {}) for doc in documents]
-
-        collection.add(
-            ids=ids,
-            documents=contents,
-            embeddings=embeddings,
-            metadatas=metadatas,
-        )
+        # 统一打包为 float32 矩阵再交给 Chroma (HNSW 索引内部即以 float32 存储)
+        matrix = np.asarray(embeddings, dtype=np.float32)
+
+        # 分批写入：单次 add 不能超过 Chroma 的最大批量，过大的批次也会占用大量内存
+        batch_size = min(settings.VECTOR_ADD_BATCH_SIZE, self._max_batch_size())
+        for start in range(0, len(ids), batch_size):
+            end = start + batch_size
+            self._with_collection(
+                kb_id,
+                lambda collection: collection.add(
+                    ids=ids[start:end],
+                    documents=contents[start:end],
+                    embeddings=matrix[start:end],
+                    metadatas=metadatas[start:end],
+                ),
+                create=True,
+            )
 
     def query(
         self,
@@ -82,6 +100,7 @@ class VectorStoreService:
         query_vector: List[float],
         top_k: int = 5,
         score_threshold: float = 0.0,
+        exact_rescore: bool = False,
     ) -> List[Dict[str, Any]]:
         """
         向量检索
@@ -91,63 +110,142 @@ class VectorStoreService:
             query_vector: 查询向量
             top_k: 返回结果数量
             score_threshold: 相似度阈值
+            exact_rescore: 是否取回候选向量并用精确余弦相似度作为 score
+                (不依赖 Collection 的距离度量，跨知识库的分数可直接比较)；
+                默认的 score 为 1 - 距离/2，向量未归一化时两者尺度不同，score_threshold 需按所选尺度设置
 
         Returns:
             检索结果列表
         """
-        collection_name = self._get_collection_name(kb_id)
+        return self.query_batch(kb_id, [query_vector], top_k, score_threshold, exact_rescore)[0]
 
-        try:
-            collection = self.client.get_collection(name=collection_name)
-        except Exception:
+    def query_batch(
+        self,
+        kb_id: str,
+        query_vectors: List[List[float]],
+        top_k: int = 5,
+        score_threshold: float = 0.0,
+        exact_rescore: bool = False,
+    ) -> List[List[Dict[str, Any]]]:
+        """
+        批量向量检索，多个查询向量只调用一次 collection.query
+
+        Returns:
+            与 query_vectors 顺序一致的检索结果列表
+        """
+        if not query_vectors:
             return []
 
-        results = collection.query(
-            query_embeddings=[query_vector],
-            n_results=top_k,
-            include=["documents", "metadatas", "distances"],
+        include = ["documents", "metadatas", "distances"]
+        if exact_rescore:
+            include.append("embeddings")
+
+        try:
+            self._get_collection(kb_id)
+        except Exception:
+            # Collection 不存在 (知识库尚未入库) 时视为无结果；检索本身的错误向上抛出
+            return [[] for _ in query_vectors]
+
+        results = self._with_collection(
+            kb_id,
+            lambda collection: collection.query(
+                query_embeddings=query_vectors,
+                n_results=top_k,
+                include=include,
+            ),
         )
 
         # 处理结果
-        output = []
-        if results and results["ids"] and results["ids"][0]:
-            for i, doc_id in enumerate(results["ids"][0]):
-                # ChromaDB 返回的是距离，转换为相似度
-                distance = results["distances"][0][i] if results["distances"] else 0
-                # 使用余弦距离转相似度: similarity = 1 - distance/2
-                score = 1 - distance / 2
-
-                if score >= score_threshold:
-                    output.append({
-                        "id": doc_id,
-                        "content": results["documents"][0][i] if results["documents"] else "",
-                        "metadata": results["metadatas"][0][i] if results["metadatas"] else {},
-                        "score": score,
-                    })
-
-        return output
+        outputs = []
+        for q, query_vector in enumerate(query_vectors):
+            output = []
+            if results and results["ids"] and results["ids"][q]:
+                exact_scores = None
+                if exact_rescore and results.get("embeddings") is not None and len(results["embeddings"][q]):
+                    exact_scores = self.cosine_scores(query_vector, results["embeddings"][q])
+
+                for i, doc_id in enumerate(results["ids"][q]):
+                    if exact_scores is not None:
+                        score = exact_scores[i]
+                    else:
+                        # ChromaDB 返回的是距离，转换为相似度
+                        distance = results["distances"][q][i] if results["distances"] else 0
+                        # 使用余弦距离转相似度: similarity = 1 - distance/2
+                        score = 1 - distance / 2
+
+                    if score >= score_threshold:
+                        output.append({
+                            "id": doc_id,
+                            "content": results["documents"][q][i] if results["documents"] else "",
+                            "metadata": results["metadatas"][q][i] if results["metadatas"] else {},
+                            "score": score,
+                        })
+            outputs.append(output)
+
+        return outputs
 
     def delete_by_file_id(self, kb_id: str, file_id: str) -> None:
         """删除指定文件的所有向量"""
-        collection_name = self._get_collection_name(kb_id)
-
         try:
-            collection = self.client.get_collection(name=collection_name)
             # 根据 metadata 中的 file_id 删除
-            collection.delete(where={"file_id": file_id})
+            self._with_collection(kb_id, lambda collection: collection.delete(where={"file_id": file_id}))
         except Exception:
             pass
 
     def get_count(self, kb_id: str) -> int:
         """获取知识库中的向量数量"""
-        collection_name = self._get_collection_name(kb_id)
-
         try:
-            collection = self.client.get_collection(name=collection_name)
-            return collection.count()
+            return self._with_collection(kb_id, lambda collection: collection.count())
         except Exception:
             return 0
 
+    @classmethod
+    def _max_batch_size(cls) -> int:
+        """Chroma 单次写入的最大条数 (新版本为 get_max_batch_size()，旧版本为 max_batch_size 属性)"""
+        if cls._max_batch is None:
+            client = cls.get_client()
+            getter = getattr(client, "get_max_batch_size", None)
+            cls._max_batch = getter() if getter else client.max_batch_size
+        return cls._max_batch
+
+    def _get_collection(self, kb_id: str, create: bool = False):
+        """获取 Collection 句柄 (优先使用缓存)"""
+        collection = self._collections.get(kb_id)
+        if collection is None:
+            collection_name = self._get_collection_name(kb_id)
+            if create:
+                collection = self.client.get_or_create_collection(name=collection_name)
+            else:
+                collection = self.client.get_collection(name=collection_name)
+            with self._collections_lock:
+                self._collections[kb_id] = collection
+        return collection
+
+    def _evict_collection(self, kb_id: str) -> None:
+        with self._collections_lock:
+            self._collections.pop(kb_id, None)
+
+    def _with_collection(self, kb_id: str, op: Callable[[Any], T], create: bool = False) -> T:
+        """
+        使用缓存的 Collection 句柄执行操作
+
+        句柄可能已失效 (Collection 被其他进程删除或重建)，失败时刷新句柄重试一次。
+        """
+        try:
+            return op(self._get_collection(kb_id, create))
+        except Exception:
+            self._evict_collection(kb_id)
+            return op(self._get_collection(kb_id, create))
+
+    @staticmethod
+    def cosine_scores(query_vector: List[float], vectors: Any) -> List[float]:
+        """批量计算查询向量与候选向量的余弦相似度"""
+        q = np.asarray(query_vector, dtype=np.float32)
+        m = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(m, axis=1) * np.linalg.norm(q)
+        norms[norms == 0] = 1.0
+        return (m @ q / norms).tolist()
+
     @staticmethod
     def _get_collection_name(kb_id: str) -> str:
         """生成 Collection 名称"""
@@ -2,78 +2,111 @@
 VLM (视觉语言模型) 服务
 """
 
-import base64
+import asyncio
 import httpx
-from typing import Optional
+import orjson
+import os
+from typing import AsyncIterator, Dict, Optional, Tuple
 
 from app.core.config import get_settings
+from app.utils.async_utils import loop_local
+from app.utils.image_utils import data_uri_size, iter_data_uri_async
 
 settings = get_settings()
 
+# 请求体中图片 URL 的占位符，序列化后在此处切开，流式填入图片数据
+_IMAGE_URL_PLACEHOLDER = "__IMAGE_URL__"
+
 
 class VLMService:
     """VLM 服务"""
 
+    # 共享 HTTP 客户端 (复用连接)，httpx 连接绑定事件循环，按事件循环分别缓存
+    _clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+
     def __init__(self):
         self.base_url = settings.VLM_BASE_URL
         self.api_key = settings.VLM_API_KEY
         self.model = settings.VLM_MODEL
         self.prompt = settings.VLM_PROMPT
 
+    @classmethod
+    def _http_client(cls) -> httpx.AsyncClient:
+        return loop_local(
+            cls._clients,
+            lambda: httpx.AsyncClient(
+                timeout=120.0,
+                verify=False,
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+            ),
+        )
+
+    @classmethod
+    async def aclose(cls) -> None:
+        """关闭当前事件循环的共享 HTTP 客户端 (应用关闭时调用)"""
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
     async def describe_image(self, image_path: str) -> str:
         """获取图片描述"""
         try:
-            # 读取图片并转为 base64
-            with open(image_path, "rb") as f:
-                image_data = base64.b64encode(f.read()).decode("utf-8")
-
-            # 判断图片类型
-            ext = image_path.split(".")[-1].lower()
-            mime_type = {
-                "png": "image/png",
-                "jpg": "image/jpeg",
-                "jpeg": "image/jpeg",
-                "gif": "image/gif",
-                "webp": "image/webp",
-            }.get(ext, "image/png")
-
-            # 构建请求
-            async with httpx.AsyncClient(timeout=120.0, verify=False) as client:
-                response = await client.post(
-                    f"{self.base_url}/chat/completions",
-                    headers={
-                        "Authorization": f"Bearer {self.api_key}",
-                        "Content-Type": "application/json",
-                    },
-                    json={
-                        "model": self.model,
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "type": "text",
-                                        "text": self.prompt,
-                                    },
-                                    {
-                                        "type": "image_url",
-                                        "image_url": {
-                                            "url": f"data:{mime_type};base64,{image_data}"
-                                        },
-                                    },
-                                ],
-                            }
-                        ],
-                        "max_tokens": 1000,
-                    },
-                )
-
-                if response.status_code != 200:
-                    raise Exception(f"VLM API 错误: {response.text}")
-
-                result = response.json()
-                return result["choices"][0]["message"]["content"]
+            # 请求体流式发送：JSON 在图片 URL 处切开，中间逐块读取、编码图片，
+            # 图片与完整的 base64 / JSON 都不整体驻留内存
+            prefix, suffix = self._request_body_parts()
+            file_size = (await asyncio.to_thread(os.stat, image_path)).st_size
+            content_length = len(prefix) + data_uri_size(image_path, file_size) + len(suffix)
+
+            async def body() -> AsyncIterator[bytes]:
+                yield prefix
+                async for chunk in iter_data_uri_async(image_path):
+                    yield chunk
+                yield suffix
+
+            client = self._http_client()
+            response = await client.post(
+                f"{self.base_url}/chat/completions",
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json",
+                    "Content-Length": str(content_length),
+                },
+                content=body(),
+            )
+
+            if response.status_code != 200:
+                raise Exception(f"VLM API 错误: {response.text}")
+
+            result = orjson.loads(response.content)
+            return result["choices"][0]["message"]["content"]
 
         except Exception as e:
             print(f"VLM 调用失败: {e}")
             return "图片解析失败"
+
+    def _request_body_parts(self) -> Tuple[bytes, bytes]:
+        """序列化请求体并在图片 URL 处切开，返回 (前半段, 后半段)"""
+        body = orjson.dumps({
+            "model": self.model,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": self.prompt,
+                        },
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": _IMAGE_URL_PLACEHOLDER
+                            },
+                        },
+                    ],
+                }
+            ],
+            "max_tokens": 1000,
+        })
+        # 占位符在 prompt 之后，从右侧切开
+        prefix, suffix = body.rsplit(_IMAGE_URL_PLACEHOLDER.encode(), 1)
+        return prefix, suffix
@@ -1,8 +1,18 @@
 """
 Celery 应用配置
+
+任务按耗时分到两个队列：parse_slow (文件解析，逐张图片调用 VLM，可能持续数分钟)
+与 embed (提交分块 / 向量化)，避免短任务排在长任务后面。可按队列分别启动 worker：
+
+    celery -A app.tasks.celery_app worker -Q parse_slow -Ofair --without-heartbeat --without-gossip --without-mingle
+    celery -A app.tasks.celery_app worker -Q embed -Ofair --without-heartbeat --without-gossip --without-mingle
+
+不指定 -Q 时 worker 消费下面声明的全部队列。
 """
 
 from celery import Celery
+from celery.signals import worker_process_shutdown
+from kombu import Queue
 from app.core.config import get_settings
 
 settings = get_settings()
@@ -26,6 +36,48 @@ celery_app.conf.update(
     enable_utc=True,
     task_track_started=True,
     task_time_limit=3600,  # 1 小时超时
+    # 解析/向量化任务主要在等待 VLM、Embedding 接口，属于 I/O 密集型，
+    # 并发数 (MAX_PARSING_WORKERS) 可以高于 CPU 核数，一般取 2 * CPU + 1
     worker_concurrency=settings.MAX_PARSING_WORKERS,
-    worker_prefetch_multiplier=1,
+    worker_prefetch_multiplier=1,  # 长任务不预取，避免排在正在执行的任务后面
+    # 任务执行完成后再确认：worker 进程被重启/关闭时未完成的任务重新投递，而不是丢失。
+    # 不开启 task_reject_on_worker_lost：子进程崩溃 (如解析大 PDF 时 OOM) 的任务直接标记失败，避免无限重新入队
+    task_acks_late=True,
+    # Redis broker 在可见性超时后会把未确认的任务重新投递，必须明显大于 task_time_limit，
+    # 否则接近时限的长任务会在仍在执行时被投递给另一个 worker
+    broker_transport_options={"visibility_timeout": 3 * 3600},
+    # 子进程执行一定数量任务后重启，释放模型加载等累积的内存
+    worker_max_tasks_per_child=50,
+    broker_connection_retry_on_startup=True,
+    result_expires=3600,  # 任务结果保留 1 小时
+    worker_disable_rate_limits=True,  # 未使用速率限制
+    task_queues=(
+        Queue("parse_slow"),
+        Queue("embed"),
+    ),
+    task_default_queue="embed",
+    task_routes={
+        "app.tasks.parse_tasks.parse_file_task": {"queue": "parse_slow"},
+        "app.tasks.parse_tasks.submit_chunks_task": {"queue": "embed"},
+        "app.tasks.vectorize_tasks.*": {"queue": "embed"},
+    },
 )
+
+
+@worker_process_shutdown.connect
+def _close_worker_resources(**kwargs):
+    """子进程退出时关闭共享 HTTP 连接池与 run_async 复用的事件循环"""
+    from app.services.embedding import EmbeddingService
+    from app.services.llm import LLMService
+    from app.services.rerank import RerankService
+    from app.services.vlm import VLMService
+    from app.utils.async_utils import close_thread_loop
+
+    async def cleanup() -> None:
+        await EmbeddingService.aclose()
+        await VLMService.aclose()
+        await LLMService.aclose()
+        await RerankService.aclose()
+
+    close_thread_loop(cleanup)
+    RerankService.close()
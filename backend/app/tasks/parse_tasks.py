@@ -2,19 +2,30 @@
 文件解析任务
 """
 
-import asyncio
-from datetime import datetime
+import hashlib
+import logging
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import numpy as np
+from sqlalchemy import delete, insert, update
 from sqlmodel import Session, select
 
 from app.tasks.celery_app import celery_app
+from app.core.config import get_settings
 from app.core.database import engine
 from app.models import FileDocument, DocumentChunk, FileStatus, ContentType, KnowledgeBase, CustomModel
+from app.models.models import generate_uuid
 from app.services.parser import FileParser
 from app.services.vector_store import VectorStoreService
-from app.services.embedding import EmbeddingService
+from app.services.embedding import EmbeddingService, EmbedInput
+from app.utils.async_utils import run_async
 from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
 from sqlalchemy.exc import OperationalError
 
+settings = get_settings()
+logger = logging.getLogger(__name__)
+
 # 定义重试策略：捕获 OperationalError (通常包含 database is locked)，最多重试 5 次，指数退避
 db_retry = retry(
     stop=stop_after_attempt(5),
@@ -28,14 +39,109 @@ def safe_commit(session: Session):
     session.commit()
 
 
-def run_async(coro):
-    """在同步环境中运行异步函数"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
+def _chunk_row(
+    file_id: str,
+    idx: int,
+    content: str,
+    page_number: Optional[int],
+    content_type: ContentType,
+    image_path: Optional[str],
+    created_at: datetime,
+) -> dict:
+    """构造 document_chunks 的一行 (批量 INSERT 不经过 ORM，主键与创建时间在此生成)"""
+    return {
+        "id": generate_uuid(),
+        "file_id": file_id,
+        "content": content,
+        "page_number": page_number,
+        "content_type": content_type,
+        "image_path": image_path,
+        "original_index": idx,
+        "created_at": created_at,
+    }
+
+
+def _insert_chunks(session: Session, rows: list) -> None:
+    """批量写入分块 (一次 executemany，不逐个 session.add)"""
+    if rows:
+        session.exec(insert(DocumentChunk), params=rows)
+
+
+def _embed_cache_key(service: EmbeddingService, model_id: str, item: EmbedInput) -> str:
+    """Embedding 缓存键: SHA256(接口地址 + 模型 + 输入内容)"""
+    if isinstance(item, dict):
+        content = f"{item.get('type')}\0{item.get('path')}\0{item.get('text')}"
+    else:
+        content = item
+    digest = hashlib.sha256(f"{service.base_url}\0{model_id}\0{content}".encode()).hexdigest()
+    return f"embed:{digest}"
+
+
+def _embed_with_cache(service: EmbeddingService, contents: List[EmbedInput], model_id: str) -> List[List[float]]:
+    """
+    带 Redis 缓存的批量 Embedding
+
+    按内容哈希查询 Redis (复用 Celery 结果后端的连接)，只对未命中的输入调用 Embedding 接口，
+    新结果以 float32 字节写回并设置过期时间。Redis 不可用时退化为直接请求全部输入。
+    """
+    if not contents or settings.EMBED_CACHE_TTL <= 0:
+        return run_async(service.embed_documents(contents, model_id=model_id, batch_size=settings.EMBED_BATCH_SIZE))
+
+    # 同一文件内重复的分块 (如每页重复的页眉) 只查询、写入一次缓存
+    slots: Dict[str, int] = {}
+    keys: List[str] = []
+    positions = []
+    unique_contents: List[EmbedInput] = []
+    for item in contents:
+        key = _embed_cache_key(service, model_id, item)
+        slot = slots.get(key)
+        if slot is None:
+            slot = slots[key] = len(keys)
+            keys.append(key)
+            unique_contents.append(item)
+        positions.append(slot)
+
     try:
-        return loop.run_until_complete(coro)
-    finally:
-        loop.close()
+        redis = celery_app.backend.client
+        cached = redis.mget(keys)
+    except Exception as e:
+        logger.warning("[EmbedCache] 读取缓存失败: %s", e)
+        redis = None
+        cached = [None] * len(keys)
+
+    embeddings: List[Optional[List[float]]] = [
+        np.frombuffer(raw, dtype=np.float32).tolist() if raw else None for raw in cached
+    ]
+    missing = [i for i, emb in enumerate(embeddings) if emb is None]
+    logger.info("[EmbedCache] 缓存命中 %d/%d (去重后)", len(keys) - len(missing), len(keys))
+    if missing:
+        fresh = run_async(service.embed_documents(
+            [unique_contents[i] for i in missing],
+            model_id=model_id,
+            batch_size=settings.EMBED_BATCH_SIZE,
+        ))
+        for i, emb in zip(missing, fresh):
+            embeddings[i] = emb
+
+        if redis is not None:
+            try:
+                with redis.pipeline(transaction=False) as pipe:
+                    for i, emb in zip(missing, fresh):
+                        pipe.set(keys[i], np.asarray(emb, dtype=np.float32).tobytes(), ex=settings.EMBED_CACHE_TTL)
+                    pipe.execute()
+            except Exception as e:
+                logger.warning("[EmbedCache] 写入缓存失败: %s", e)
+    return [embeddings[slot] for slot in positions]
+
+
+def adjust_kb_chunk_count(session: Session, kb_id: str, delta: int) -> None:
+    """按增量原子更新知识库的 chunk_count (UPDATE ... SET chunk_count = chunk_count + delta，不对整个知识库做 COUNT)"""
+    if delta:
+        session.exec(
+            update(KnowledgeBase)
+            .where(KnowledgeBase.id == kb_id)
+            .values(chunk_count=KnowledgeBase.chunk_count + delta, updated_at=datetime.now(timezone.utc))
+        )
 
 
 @celery_app.task(bind=True, max_retries=3)
@@ -60,40 +166,45 @@ def process_submitted_chunks(file_id: str, chunks_data: list):
     """
     处理前端提交的 chunks (包含手动修改后的内容)
     """
-    print(f"🚀 [SubmitTask] 开始处理提交的 Chunks: {file_id}, Count={len(chunks_data)}")
+    logger.info("[SubmitTask] 开始处理提交的 Chunks: %s, Count=%d", file_id, len(chunks_data))
+    # 任务开始时间：开始阶段的状态更新与分块创建时间共用
+    now = datetime.now(timezone.utc)
     with Session(engine, expire_on_commit=False) as session:
         # 获取文件记录
         file_doc = session.get(FileDocument, file_id)
         if not file_doc:
-            print(f"❌ [SubmitTask] 文件不存在: {file_id}")
+            logger.error("[SubmitTask] 文件不存在: %s", file_id)
             return {"error": "文件不存在"}
 
         try:
             # 更新状态为处理中
             file_doc.status = FileStatus.EMBEDDING # 直接进入 Embedding 阶段，因为已经 Parse 过了
             file_doc.progress = 10
-            file_doc.updated_at = datetime.utcnow()
+            file_doc.updated_at = now
             session.add(file_doc)
             safe_commit(session)
             
             # 清理旧数据
-            print("🧹 [SubmitTask] 清理旧数据...")
-            existing_chunks = session.exec(
-                select(DocumentChunk).where(DocumentChunk.file_id == file_id)
-            ).all()
-            for c in existing_chunks:
-                session.delete(c)
+            logger.info("[SubmitTask] 清理旧数据")
+            # 后续只读取这两个字段，提前取出，不再反复访问 ORM 属性
+            kb_id = file_doc.kb_id
+            file_name = file_doc.name
+            # chunk_count 与分块的删除/写入在同一事务中调整，任务中途失败也不会偏离实际行数
+            removed_count = session.exec(
+                delete(DocumentChunk).where(DocumentChunk.file_id == file_id)
+            ).rowcount
+            adjust_kb_chunk_count(session, kb_id, -removed_count)
             safe_commit(session)
 
+            vector_service = VectorStoreService()
             try:
-                vector_service = VectorStoreService()
-                vector_service.delete_by_file_id(file_doc.kb_id, file_id)
+                vector_service.delete_by_file_id(kb_id, file_id)
             except Exception as e:
-                print(f"⚠️ [SubmitTask] 清理向量库失败: {e}")
+                logger.warning("[SubmitTask] 清理向量库失败: %s", e)
 
             # 保存 Chunks
             db_chunks = []
-            print("🔄 [SubmitTask] 开始保存分块...")
+            logger.info("[SubmitTask] 开始保存分块")
 
             for idx, chunk_data in enumerate(chunks_data):
                 # chunk_data 是字典
@@ -102,46 +213,43 @@ def process_submitted_chunks(file_id: str, chunks_data: list):
                 except ValueError:
                     c_type = ContentType.TEXT
 
-                db_chunk = DocumentChunk(
-                    file_id=file_id,
-                    content=chunk_data.get("content", ""),
-                    page_number=chunk_data.get("page_number", 0),
-                    content_type=c_type,
-                    image_path=chunk_data.get("image_path", ""),
-                    original_index=idx,
-                    vlm_description=chunk_data.get("vlm_description", ""), # 支持 VLM 描述
-                )
-                db_chunks.append(db_chunk)
-                session.add(db_chunk)
+                db_chunks.append(_chunk_row(
+                    file_id,
+                    idx,
+                    chunk_data.get("content", ""),
+                    chunk_data.get("page_number", 0),
+                    c_type,
+                    chunk_data.get("image_path", ""),
+                    now,
+                ))
+            _insert_chunks(session, db_chunks)
+            adjust_kb_chunk_count(session, kb_id, len(db_chunks))
             
             # 更新进度为 50% 并提交分块
             file_doc.progress = 50
             session.add(file_doc)
             
-            safe_commit(session) # 提交以获取 ID 并保存分块
-            print(f"✅ [SubmitTask] 分块保存完成，共 {len(db_chunks)} 个")
+            safe_commit(session)
+            logger.info("[SubmitTask] 分块保存完成，共 %d 个", len(db_chunks))
 
             # 向量化并入库
-            print("🧠 [SubmitTask] 开始生成 Embedding 并入库...")
-            # 刷新对象以确保在同一事务中可用（虽然 commit 会 expire，但我们马上要用它）
-            session.refresh(file_doc)
+            logger.info("[SubmitTask] 开始生成 Embedding 并入库")
 
             try:
                 # 获取知识库信息 (为了获取 embedding_model)
-                kb = session.get(KnowledgeBase, file_doc.kb_id)
+                kb = session.get(KnowledgeBase, kb_id)
                 if not kb:
-                    raise Exception(f"知识库不存在: {file_doc.kb_id}")
+                    raise Exception(f"知识库不存在: {kb_id}")
                 
                 embedding_model_id = kb.embedding_model
-                print(f"🔍 [ParseTask] KnowledgeBase ID: {kb.id}")
-                print(f"🔍 [ParseTask] Retrieved embedding_model_id from KB: '{embedding_model_id}'")
+                logger.debug("[SubmitTask] KnowledgeBase %s, embedding_model_id=%r", kb.id, embedding_model_id)
 
                 # 检查是否为自定义模型
                 custom_model = session.get(CustomModel, embedding_model_id)
                 
                 embedding_service = None
                 if custom_model:
-                    print(f"🔍 [ParseTask] Using Custom Model: {custom_model.name} ({custom_model.model_name})")
+                    logger.debug("[SubmitTask] Using Custom Model: %s (%s)", custom_model.name, custom_model.model_name)
                     embedding_service = EmbeddingService(
                         base_url=custom_model.base_url,
                         api_key=custom_model.api_key,
@@ -150,90 +258,62 @@ def process_submitted_chunks(file_id: str, chunks_data: list):
                     # 使用实际模型名称覆盖 ID
                     embedding_model_id = custom_model.model_name
                 else:
-                    print(f"🔍 [ParseTask] Using System/Default Model: {embedding_model_id}")
+                    logger.debug("[SubmitTask] Using System/Default Model: %s", embedding_model_id)
                     embedding_service = EmbeddingService()
 
-                vector_service = VectorStoreService()
-
                 documents_for_chroma = []
                 contents_to_embed = []
 
                 for chunk in db_chunks:
-                    text_content = chunk.content
+                    text_content = chunk["content"]
                     
                     metadata = {
                         "file_id": file_id,
-                        "file_name": file_doc.name,
-                        "chunk_index": chunk.original_index,
-                        "page_number": chunk.page_number or 0,
-                        "content_type": chunk.content_type.value,
-                        "image_path": chunk.image_path or "",
-                        "location_info": f"Page {chunk.page_number or 1} | Chunk #{chunk.original_index + 1}"
+                        "file_name": file_name,
+                        "chunk_index": chunk["original_index"],
+                        "page_number": chunk["page_number"] or 0,
+                        "content_type": chunk["content_type"].value,
+                        "image_path": chunk["image_path"] or "",
+                        "location_info": f"Page {chunk['page_number'] or 1} | Chunk #{chunk['original_index'] + 1}"
                     }
                     
                     documents_for_chroma.append({
-                        "id": chunk.id,
+                        "id": chunk["id"],
                         "content": text_content,
                         "metadata": metadata
                     })
-                    contents_to_embed.append(text_content)
-
-                print(f"   -> 正在为 {len(contents_to_embed)} 个块生成向量...")
-                embeddings = run_async(embedding_service.embed_documents(contents_to_embed, model_id=embedding_model_id))
-                
-                print(f"   -> 正在写入 ChromaDB...")
-                # 由于 embedding 过程是异步的，session 可能会因为 expire_on_commit=True 而失效
-                # 虽然我们 refresh 过了，但为了保险，这里再次 refresh 或者 merge
-                # 不过 file_doc 在这里并不需要 update，我们只是用 kb_id
+                    if chunk["content_type"] == ContentType.IMAGE and chunk["image_path"]:
+                        contents_to_embed.append({"type": "image", "path": chunk["image_path"], "text": text_content})
+                    else:
+                        contents_to_embed.append(text_content)
+
+                logger.info("[SubmitTask] 正在为 %d 个块生成向量", len(contents_to_embed))
+                # 未修改的分块直接复用缓存中的向量，只对新增/修改的分块请求接口
+                embeddings = _embed_with_cache(embedding_service, contents_to_embed, embedding_model_id)
                 
+                logger.info("[SubmitTask] 正在写入 ChromaDB")
                 vector_service.add_documents(
-                    kb_id=file_doc.kb_id,
+                    kb_id=kb_id,
                     documents=documents_for_chroma,
                     embeddings=embeddings
                 )
-                print("✅ [SubmitTask] 向量入库完成！")
+                logger.info("[SubmitTask] 向量入库完成")
 
             except Exception as embed_err:
-                print(f"❌ [SubmitTask] 向量化失败: {embed_err}")
+                logger.error("[SubmitTask] 向量化失败: %s", embed_err)
                 raise embed_err
 
-            # 完成
-            # 这里必须重新获取 file_doc，因为经历了耗时的 embedding 过程，
-            # 且之前的 commit 可能导致对象过期或 detached
-            file_doc = session.get(FileDocument, file_id)
-            if file_doc:
-                file_doc.status = FileStatus.PARSED
-                file_doc.progress = 100
-                file_doc.updated_at = datetime.utcnow()
-                session.add(file_doc)
-                safe_commit(session)
+            # 完成 (session 使用 expire_on_commit=False，file_doc 在提交后仍可直接使用)
+            file_doc.status = FileStatus.PARSED
+            file_doc.progress = 100
+            file_doc.updated_at = datetime.now(timezone.utc)
+            session.add(file_doc)
+            safe_commit(session)
 
-                # 更新知识库的 chunk_count
-                try:
-                    kb = session.get(KnowledgeBase, file_doc.kb_id)
-                    if kb:
-                        # 统计该知识库下所有文件的 chunks 总数
-                        from sqlalchemy import func
-                        total_chunks = session.exec(
-                            select(func.count(DocumentChunk.id))
-                            .join(FileDocument)
-                            .where(FileDocument.kb_id == kb.id)
-                        ).one()
-                        
-                        kb.chunk_count = total_chunks
-                        kb.updated_at = datetime.utcnow()
-                        session.add(kb)
-                        safe_commit(session)
-                        print(f"✅ [SubmitTask] 更新知识库 {kb.id} 的 chunk_count 为 {total_chunks}")
-                except Exception as kb_err:
-                    print(f"⚠️ [SubmitTask] 更新知识库 chunk_count 失败: {kb_err}")
-
-            print("🎉 [SubmitTask] 任务完成。")
+            logger.info("[SubmitTask] 任务完成: %s", file_id)
 
         except Exception as e:
-            print(f"❌ [SubmitTask] 异常: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("[SubmitTask] 处理失败: %s", file_id)
             file_doc = session.get(FileDocument, file_id)
             if file_doc:
                 file_doc.status = FileStatus.FAILED
@@ -254,40 +334,42 @@ def process_file_parsing(
     """
     解析文件核心逻辑（解耦 Celery）
     """
-    print(f"🚀 [ParseTask] 开始处理文件解析: {file_id}, Mode={chunk_mode}")
+    logger.info("[ParseTask] 开始处理文件解析: %s, Mode=%s", file_id, chunk_mode)
+    # 任务开始时间：开始阶段的状态更新与分块创建时间共用
+    now = datetime.now(timezone.utc)
     with Session(engine) as session:
         # 获取文件记录
         file_doc = session.get(FileDocument, file_id)
         if not file_doc:
-            print(f"❌ [ParseTask] 文件不存在: {file_id}")
+            logger.error("[ParseTask] 文件不存在: %s", file_id)
             return {"error": "文件不存在"}
 
         try:
-            print(f"📄 [ParseTask] 文件信息: {file_doc.name}, 路径: {file_doc.local_path}")
+            logger.info("[ParseTask] 文件信息: %s, 路径: %s", file_doc.name, file_doc.local_path)
             
             # 更新状态为解析中
             file_doc.status = FileStatus.PARSING
             file_doc.progress = 0
-            file_doc.updated_at = datetime.utcnow()
+            file_doc.updated_at = now
             session.add(file_doc)
             safe_commit(session)
             
             # 清理旧的 Chunks (支持重解析)
-            print("🧹 [ParseTask] 清理旧数据...")
-            existing_chunks = session.exec(
-                select(DocumentChunk).where(DocumentChunk.file_id == file_id)
-            ).all()
-            for c in existing_chunks:
-                session.delete(c)
+            logger.info("[ParseTask] 清理旧数据")
+            # chunk_count 与分块的删除/写入在同一事务中调整
+            removed_count = session.exec(
+                delete(DocumentChunk).where(DocumentChunk.file_id == file_id)
+            ).rowcount
+            adjust_kb_chunk_count(session, file_doc.kb_id, -removed_count)
             safe_commit(session)
 
             # 清理向量库中的旧数据
             try:
                 vector_service = VectorStoreService()
                 vector_service.delete_by_file_id(file_doc.kb_id, file_id)
-                print(f"🧹 [ParseTask] 已从向量库清理文件 {file_id} 的数据")
+                logger.info("[ParseTask] 已从向量库清理文件 %s 的数据", file_id)
             except Exception as e:
-                print(f"⚠️ [ParseTask] 清理向量库失败 (可能之前未入库): {e}")
+                logger.warning("[ParseTask] 清理向量库失败 (可能之前未入库): %s", e)
 
             # 初始化解析器
             parser = FileParser(kb_id=file_doc.kb_id)
@@ -296,7 +378,7 @@ def process_file_parsing(
             file_doc.progress = 10
             session.add(file_doc)
             safe_commit(session)
-            print("✅ [ParseTask] 开始调用 parser.parse()...")
+            logger.info("[ParseTask] 开始调用 parser.parse()")
 
             # 同步调用解析
             try:
@@ -307,16 +389,15 @@ def process_file_parsing(
                     chunk_overlap=chunk_overlap,
                     separator=separator
                 )
-                print(f"✅ [ParseTask] 解析完成，获得 {len(parsed_chunks)} 个块")
+                logger.info("[ParseTask] 解析完成，获得 %d 个块", len(parsed_chunks))
             except Exception as parse_err:
-                print(f"❌ [ParseTask] parser.parse() 内部抛出异常: {parse_err}")
-                import traceback
-                traceback.print_exc()
+                # 堆栈由外层统一记录
+                logger.error("[ParseTask] parser.parse() 内部抛出异常: %s", parse_err)
                 raise parse_err
 
             # 保存 Chunks
             db_chunks = []
-            print("🔄 [ParseTask] 开始保存分块...")
+            logger.info("[ParseTask] 开始保存分块")
 
             for idx, chunk in enumerate(parsed_chunks):
                 # 映射 ContentType
@@ -325,42 +406,39 @@ def process_file_parsing(
                 except ValueError:
                     c_type = ContentType.TEXT
 
-                db_chunk = DocumentChunk(
-                    file_id=file_id,
-                    content=chunk.content,
-                    page_number=chunk.page_number,
-                    content_type=c_type,
-                    image_path=chunk.image_path,
-                    original_index=idx,
-                )
-                db_chunks.append(db_chunk)
-                session.add(db_chunk)
+                db_chunks.append(_chunk_row(
+                    file_id,
+                    idx,
+                    chunk.content,
+                    chunk.page_number,
+                    c_type,
+                    chunk.image_path,
+                    now,
+                ))
+            _insert_chunks(session, db_chunks)
+            adjust_kb_chunk_count(session, file_doc.kb_id, len(db_chunks))
 
-            print(f"✅ [ParseTask] 分块处理完成，共生成 {len(db_chunks)} 个数据库记录块")
+            logger.info("[ParseTask] 分块处理完成，共生成 %d 个数据库记录块", len(db_chunks))
 
             # 更新文件状态为解析完成 (PENDING_CONFIRM)
             file_doc.status = FileStatus.PENDING_CONFIRM
             file_doc.progress = 50
-            file_doc.updated_at = datetime.utcnow()
+            file_doc.updated_at = datetime.now(timezone.utc)
             session.add(file_doc)
-            
-            # 暂时不更新知识库分块计数，因为还未入库
-            # ...
 
             safe_commit(session)
-            print("🎉 [ParseTask] 解析完成，等待用户确认入库。")
+            logger.info("[ParseTask] 解析完成，等待用户确认入库: %s", file_id)
             
             # 准备自动向量化的数据
             auto_vectorize_data = None
             if auto_vectorize:
-                print(f"🚀 [ParseTask] 自动触发向量化入库: {file_id}")
+                logger.info("[ParseTask] 自动触发向量化入库: %s", file_id)
                 auto_vectorize_data = [
                     {
-                        "content": c.content,
-                        "page_number": c.page_number,
-                        "content_type": c.content_type.value,
-                        "image_path": c.image_path,
-                        "vlm_description": c.vlm_description if hasattr(c, "vlm_description") else None,
+                        "content": c["content"],
+                        "page_number": c["page_number"],
+                        "content_type": c["content_type"].value,
+                        "image_path": c["image_path"],
                     }
                     for c in db_chunks
                 ]
@@ -378,16 +456,14 @@ def process_file_parsing(
 
         except Exception as e:
             # 更新状态为失败
-            print(f"❌ [ParseTask] 全局异常捕获: {e}")
-            import traceback
-            traceback.print_exc()
+            logger.exception("[ParseTask] 解析失败: %s", file_id)
             
             # 重新获取 session 中的对象以防过期
             file_doc = session.get(FileDocument, file_id)
             if file_doc:
                 file_doc.status = FileStatus.FAILED
                 file_doc.error_message = str(e)
-                file_doc.updated_at = datetime.utcnow()
+                file_doc.updated_at = datetime.now(timezone.utc)
                 session.add(file_doc)
                 safe_commit(session)
             
@@ -2,25 +2,20 @@
 向量化任务
 """
 
-import asyncio
-from datetime import datetime
+import logging
+from datetime import datetime, timezone
 from sqlmodel import Session, select
 
 from app.tasks.celery_app import celery_app
+from app.core.config import get_settings
 from app.core.database import engine
-from app.models import FileDocument, DocumentChunk, KnowledgeBase, FileStatus, CustomModel
+from app.models import FileDocument, DocumentChunk, KnowledgeBase, FileStatus, CustomModel, ContentType
 from app.services.embedding import EmbeddingService
 from app.services.vector_store import VectorStoreService
+from app.utils.async_utils import run_async
 
-
-def run_async(coro):
-    """在同步环境中运行异步函数"""
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
-    try:
-        return loop.run_until_complete(coro)
-    finally:
-        loop.close()
+settings = get_settings()
+logger = logging.getLogger(__name__)
 
 
 @celery_app.task(bind=True, max_retries=3)
@@ -83,36 +78,37 @@ def vectorize_file_task(self, file_id: str):
             documents = []
             contents = []
 
+            file_name = file_doc.name
             for chunk in chunks:
                 documents.append({
                     "id": chunk.id,
                     "content": chunk.content,
                     "metadata": {
                         "file_id": file_id,
-                        "file_name": file_doc.name,
+                        "file_name": file_name,
                         "page_number": chunk.page_number,
                         "content_type": chunk.content_type.value,
                         "location_info": f"第 {chunk.page_number} 页" if chunk.page_number else "",
                     },
                 })
-                contents.append(chunk.content)
-
-            # 批量生成向量
-            total = len(contents)
-            batch_size = 10
-            all_embeddings = []
-
-            for i in range(0, total, batch_size):
-                batch = contents[i:i + batch_size]
-                embeddings = run_async(embedding_service.embed_documents(batch, model_id=target_model_id))
-                all_embeddings.extend(embeddings)
-
-                # 更新进度
-                progress = int((i + len(batch)) / total * 90)
-                file_doc.progress = progress
+                if chunk.content_type == ContentType.IMAGE and chunk.image_path:
+                    contents.append({"type": "image", "path": chunk.image_path, "text": chunk.content})
+                else:
+                    contents.append(chunk.content)
+
+            # 批量生成向量 (按 EMBED_BATCH_SIZE 分批并发请求)
+            def update_progress(done: int, total: int) -> None:
+                file_doc.progress = int(done / total * 90)
                 session.add(file_doc)
                 session.commit()
 
+            all_embeddings = run_async(embedding_service.embed_documents(
+                contents,
+                model_id=target_model_id,
+                batch_size=settings.EMBED_BATCH_SIZE,
+                on_progress=update_progress,
+            ))
+
             # 存入向量库
             vector_service.add_documents(
                 kb_id=file_doc.kb_id,
@@ -121,17 +117,15 @@ def vectorize_file_task(self, file_id: str):
             )
 
             # 更新文件状态
+            now = datetime.now(timezone.utc)
             file_doc.status = FileStatus.READY
             file_doc.progress = 100
-            file_doc.updated_at = datetime.utcnow()
+            file_doc.updated_at = now
             session.add(file_doc)
 
-            # 更新知识库统计
-            kb = session.get(KnowledgeBase, file_doc.kb_id)
+            # 更新知识库时间 (chunk_count 已在分块写入/删除时增量维护；kb 复用前面查询的对象)
             if kb:
-                # 重新计算总 chunk 数
-                kb.chunk_count = vector_service.get_count(kb.id)
-                kb.updated_at = datetime.utcnow()
+                kb.updated_at = now
                 session.add(kb)
 
             session.commit()
@@ -143,10 +137,11 @@ def vectorize_file_task(self, file_id: str):
             }
 
         except Exception as e:
+            logger.exception("[VectorizeTask] 向量化失败: %s", file_id)
             # 更新状态为失败
             file_doc.status = FileStatus.FAILED
             file_doc.error_message = str(e)
-            file_doc.updated_at = datetime.utcnow()
+            file_doc.updated_at = datetime.now(timezone.utc)
             session.add(file_doc)
             session.commit()
 
@@ -2,6 +2,11 @@
 工具函数
 """
 
+import importlib.util
+
+# httpx 的 HTTP/2 支持依赖 h2 包 (httpx[http2])，未安装时回退到 HTTP/1.1
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
 
 def truncate_string(s: str, max_length: int = 200) -> str:
     """截断字符串"""
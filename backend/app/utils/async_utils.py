@@ -0,0 +1,79 @@
+"""
+异步工具
+"""
+
+import asyncio
+import os
+import threading
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+_lock = threading.Lock()
+
+
+def loop_local(store: Dict[asyncio.AbstractEventLoop, T], factory: Callable[[], T]) -> T:
+    """
+    获取当前事件循环对应的对象，不存在时调用 factory 创建
+
+    asyncio 原语与 httpx 连接都绑定事件循环 (Celery 任务每次调用都会新建循环)，
+    因此按事件循环分别缓存。创建新对象时顺带清理已关闭事件循环的条目。
+    """
+    loop = asyncio.get_running_loop()
+    value = store.get(loop)
+    if value is None:
+        with _lock:
+            value = store.get(loop)
+            if value is None:
+                for stale in [l for l in store if l.is_closed()]:
+                    del store[stale]
+                value = store[loop] = factory()
+    return value
+
+
+class _ThreadLoop:
+    """线程专属的事件循环，线程结束 (本对象被回收) 时关闭"""
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.loop = asyncio.new_event_loop()
+
+    def __del__(self):
+        # fork 出的子进程不关闭父进程创建的事件循环
+        if self.pid == os.getpid() and not self.loop.is_closed():
+            self.loop.close()
+
+
+_thread_loops = threading.local()
+
+
+def run_async(coro: Awaitable[T]) -> T:
+    """
+    在同步环境 (Celery 任务、后台任务线程) 中运行协程
+
+    同一线程复用同一个事件循环，按事件循环缓存的 HTTP 客户端与连接池可以跨调用、跨任务复用；
+    Celery prefork 子进程不会沿用 fork 前父进程的事件循环。
+    """
+    holder = getattr(_thread_loops, "holder", None)
+    if holder is None or holder.pid != os.getpid() or holder.loop.is_closed():
+        holder = _thread_loops.holder = _ThreadLoop()
+    asyncio.set_event_loop(holder.loop)
+    return holder.loop.run_until_complete(coro)
+
+
+def close_thread_loop(cleanup: Optional[Callable[[], Awaitable[None]]] = None) -> None:
+    """
+    关闭当前线程由 run_async 创建的事件循环 (Celery 子进程退出时调用)
+
+    cleanup 在关闭前于该事件循环上执行，用于关闭绑定在此循环上的 HTTP 客户端。
+    """
+    holder = getattr(_thread_loops, "holder", None)
+    if holder is None or holder.pid != os.getpid() or holder.loop.is_closed():
+        return
+    try:
+        if cleanup is not None:
+            holder.loop.run_until_complete(cleanup())
+        holder.loop.run_until_complete(holder.loop.shutdown_asyncgens())
+    finally:
+        holder.loop.close()
+        _thread_loops.holder = None
@@ -0,0 +1,155 @@
+"""
+图片处理工具
+"""
+
+import asyncio
+import base64
+import os
+import struct
+import threading
+from collections import OrderedDict
+from typing import AsyncIterator, Optional, Tuple
+
+from app.core.config import get_settings
+
+settings = get_settings()
+
+# data URI 缓存: (路径, mtime_ns, 大小) -> data URI，按总字节数 (DATA_URI_CACHE_BYTES) 淘汰
+_data_uri_cache: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_data_uri_cache_bytes = 0
+_cache_lock = threading.Lock()
+
+_B64_CHUNK_SIZE = 57 * 1024  # 3 的倍数
+
+# 常见扩展名 -> image/* 子类型 (未列出的扩展名按 png 处理)
+_MIME_SUBTYPE_BY_EXT = {
+    ".png": "png",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".gif": "gif",
+    ".webp": "webp",
+    ".bmp": "bmp",
+}
+
+
+def image_mime_subtype(path: str) -> str:
+    """根据扩展名获取 image/* 的子类型 (未知扩展名按 png 处理)"""
+    ext = os.path.splitext(path)[1].lower()
+    return _MIME_SUBTYPE_BY_EXT.get(ext, "png")
+
+
+def image_size_from_header(data: bytes) -> Tuple[int, int]:
+    """
+    从图片头部读取宽高 (支持 PNG / JPEG)，无需解码整张图片
+
+    Returns:
+        (宽, 高)，无法识别时返回 (0, 0)
+    """
+    if data[:8] == b"\x89PNG\r\n\x1a\n" and len(data) >= 24:
+        return struct.unpack(">II", data[16:24])
+
+    if data[:2] == b"\xff\xd8":
+        i = 2
+        while i + 9 <= len(data):
+            if data[i] != 0xFF:
+                break
+            marker = data[i + 1]
+            if marker == 0xFF:  # 填充字节
+                i += 1
+                continue
+            # SOF0 ~ SOF15 (排除 DHT/JPG/DAC) 中记录了图片尺寸
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                height, width = struct.unpack(">HH", data[i + 5 : i + 9])
+                return width, height
+            i += 2 + struct.unpack(">H", data[i + 2 : i + 4])[0]
+
+    return 0, 0
+
+
+def _read_and_b64(path: str) -> str:
+    # 分块读取并编码 (块大小为 3 的倍数，中间块不产生填充)，不再一次性读入整图；
+    # 前缀与各块最后只拼接、解码一次
+    parts = [f"data:image/{image_mime_subtype(path)};base64,".encode("ascii")]
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(_B64_CHUNK_SIZE)
+            if not chunk:
+                break
+            parts.append(base64.b64encode(chunk))
+    return b"".join(parts).decode("ascii")
+
+
+async def iter_data_uri_async(path: str) -> AsyncIterator[bytes]:
+    """
+    逐块产出图片 data URI 的字节 (前缀 + 分块 base64)，用于流式构造请求体
+
+    文件读取在线程中执行；不缓存，内存占用只有一个块。
+    """
+    yield f"data:image/{image_mime_subtype(path)};base64,".encode("ascii")
+    f = await asyncio.to_thread(open, path, "rb")
+    try:
+        while True:
+            chunk = await asyncio.to_thread(f.read, _B64_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield base64.b64encode(chunk)
+    finally:
+        f.close()
+
+
+def data_uri_size(path: str, file_size: int) -> int:
+    """图片 data URI 的字节长度 (与 iter_data_uri_async 的产出一致)"""
+    return len(f"data:image/{image_mime_subtype(path)};base64,") + 4 * ((file_size + 2) // 3)
+
+
+def _cache_key(path: str, stat: os.stat_result) -> Tuple[str, int, int]:
+    return (path, stat.st_mtime_ns, stat.st_size)
+
+
+def _cache_get(key: Tuple[str, int, int]) -> Optional[str]:
+    with _cache_lock:
+        data_uri = _data_uri_cache.get(key)
+        if data_uri is not None:
+            _data_uri_cache.move_to_end(key)
+        return data_uri
+
+
+def _cache_put(key: Tuple[str, int, int], data_uri: str) -> None:
+    """写入缓存；超过单条上限的大图不缓存，总字节数超出预算时淘汰最久未用的条目"""
+    global _data_uri_cache_bytes
+    size = len(data_uri)
+    if size > settings.DATA_URI_CACHE_MAX_ITEM_BYTES or size > settings.DATA_URI_CACHE_BYTES:
+        return
+    with _cache_lock:
+        old = _data_uri_cache.pop(key, None)
+        if old is not None:
+            _data_uri_cache_bytes -= len(old)
+        _data_uri_cache[key] = data_uri
+        _data_uri_cache_bytes += size
+        while _data_uri_cache_bytes > settings.DATA_URI_CACHE_BYTES:
+            _, evicted = _data_uri_cache.popitem(last=False)
+            _data_uri_cache_bytes -= len(evicted)
+
+
+def encode_image(path: str) -> str:
+    """
+    读取图片并编码为 data URI
+
+    结果按 (路径, mtime, 大小) 缓存，入库 Embedding 与对话注入共用同一份编码结果。
+    """
+    key = _cache_key(path, os.stat(path))
+    data_uri = _cache_get(key)
+    if data_uri is None:
+        data_uri = _read_and_b64(path)
+        _cache_put(key, data_uri)
+    return data_uri
+
+
+async def encode_image_async(path: str) -> str:
+    """encode_image 的异步版本，文件读取与编码放到线程中执行，避免阻塞事件循环"""
+    key = _cache_key(path, await asyncio.to_thread(os.stat, path))
+    data_uri = _cache_get(key)
+    if data_uri is None:
+        data_uri = await asyncio.to_thread(_read_and_b64, path)
+        _cache_put(key, data_uri)
+    return data_uri